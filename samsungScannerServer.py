@@ -20,33 +20,47 @@
 
 __version__ = "0.6.1"
 
+import asyncio
 import atexit
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import errno  # t-k: needed for error handling in TCP proxy
-import io
+import glob
+import hashlib
+import json
 import logging
 import logging.handlers
+import mmap
 import multiprocessing  # t-k: need subprocesses for TCP and UDP proxy
 import os
 import os.path
+import pickle
 import platform
 import pwd  # t-k: for automatically configured OUTPUT_PREFIX and OWNER(_UID)
 import queue
 import re
+import selectors
 import signal  # t-k: for correct handling of SIGTERM and so on (which atexit can't handle)
 import socket  # t-k: needed for TCP and UDP proxy to interfere with scanner commands needed for multipage
 import sys
+import tempfile
+import threading
 import time
 import traceback
+import urllib.error
 import xml.etree.ElementTree as ET
+from http import client as http_client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from optparse import OptionGroup, OptionParser
 from string import Template
 from urllib import request
 
-import sane
-from PIL import Image
-from pypdf import PdfReader, PdfWriter
-from six.moves import http_client
+# python-sane (loads the SANE backends) and PIL are imported on first use, see import_sane(),
+#     so the log listener and the proxies are forked from a small interpreter
+sane = None
+IMPORT_START = time.monotonic()
 
 """
 Summary of messages exchanged in order to scan
@@ -104,31 +118,376 @@ if we want to unregister the server: sever -> scanner (HTTP Post) with:
 # ############################# FUNCTIONS ###############################
 
 
+# Memory: resident set size (RSS) of the daemon and its child processes
+
+HEAVY_MODULES = ('sane', 'PIL.Image', 'pysnmp')
+
+
+def rss_bytes(pid='self', field='VmRSS'):
+    """
+    resident set size of process pid in bytes (Linux only), None if unknown,
+    with field 'VmHWM' its peak (see reset_peak_rss())
+    """
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    start measuring the peak RSS of the daemon (VmHWM) again (Linux >= 4.0),
+    return whether this was possible, else the peak is the one since the start
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+class PeakRss(object):
+    """
+    peak RSS of the daemon during scan jobs: resetting it resets it for the whole process,
+    so it is only reset when a job begins while no other job is running
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = 0
+        self.begun = 0
+        self.reset = False  # whether the last reset worked, else the peak is the one since the start
+
+    @contextlib.contextmanager
+    def job(self):
+        """
+        count a job as running while in the context, which gives a function describing its peak RSS
+        """
+        with self._lock:
+            if self.running == 0:
+                self.reset = reset_peak_rss()
+            reset, shared = self.reset, self.running > 0
+            self.running += 1
+            self.begun += 1
+            begun = self.begun
+        try:
+            yield lambda: self.describe(reset, shared or self.begun != begun or self.running > 1)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    @staticmethod
+    def describe(reset, shared):
+        peak = rss_bytes(field='VmHWM')
+        if peak is None:
+            return 'peak RSS unknown'
+        if shared:
+            return 'peak RSS of the daemon %.1f MiB%s (other jobs ran as well)' % (
+                peak / (1 << 20), '' if reset else ' since start')
+        return 'peak RSS %.1f MiB%s' % (peak / (1 << 20), '' if reset else ' since start')
+
+
+peak_rss = PeakRss()
+
+
+def memory_usage():
+    """
+    return [(process name, RSS in bytes or None), ...] for the daemon and its child processes
+    """
+    return [('main', rss_bytes())] + [(child.name, rss_bytes(child.pid))
+                                      for child in multiprocessing.active_children()]
+
+
+def memory_report():
+    """
+    one line with the RSS of all processes and the heavy modules imported by the daemon
+    """
+    return '%s (imported: %s)' % (
+        ', '.join('%s %s' % (name, 'unknown' if rss is None else '%.1f MiB' % (rss / (1 << 20)))
+                  for name, rss in memory_usage()),
+        ', '.join(module for module in HEAVY_MODULES if module in sys.modules) or 'none')
+
+
+# Metrics: counters and timings of the scan jobs, served in the Prometheus text format on METRICS_PORT
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    counters, seconds spent per stage and latency histograms of the daemon,
+    updated from all threads
+    """
+
+    COUNTERS = [
+        ('jobs', 'Scan jobs finished.'),
+        ('pages', 'Pages scanned and saved.'),
+        ('written_bytes', 'Bytes written to the output files.'),
+        ('snmp_polls', 'SNMP queries of the scan status.'),
+        ('http_errors', 'Failed HTTP requests to the scanner.'),
+        ('sane_reconnects', 'Connections to the scanner opened again after SANE errors.'),
+        ('proxy_restarts', 'Restarts of the proxies between SANE and the scanner.'),
+        ('spilled_pages', 'Pages moved to temporary files because of the MEMORY_BUDGET of their job.'),
+    ]
+    HISTOGRAMS = [
+        ('page_seconds', 'Seconds from the start of scanning a page until it was written.',
+         (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)),
+        ('job_seconds', 'Seconds from selecting the server on the scanner until the last file was written.',
+         (1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)),
+    ]
+    PREFIX = 'samsung_scanner_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys([name for name, _ in self.COUNTERS], 0)
+        self.stages = {}  # stage -> [count, seconds]
+        self.histograms = {name: Histogram(buckets) for name, _, buckets in self.HISTOGRAMS}
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            totals = self.stages.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_stage(stage, time.monotonic() - start)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.histograms[name].observe(seconds)
+
+    def render(self):
+        """
+        return all metrics in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for counter, help_text in self.COUNTERS:
+                name = self.PREFIX + counter + '_total'
+                lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s counter' % name,
+                          '%s %d' % (name, self.counters[counter])]
+            name = self.PREFIX + 'stage_seconds'
+            lines += ['# HELP %s Seconds spent in the stages of the scan jobs.' % name, '# TYPE %s summary' % name]
+            for stage, (count, seconds) in sorted(self.stages.items()):
+                lines += ['%s_sum{stage="%s"} %f' % (name, stage, seconds),
+                          '%s_count{stage="%s"} %d' % (name, stage, count)]
+            for name, help_text, buckets in self.HISTOGRAMS:
+                histogram = self.histograms[name]
+                name = self.PREFIX + name
+                lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s histogram' % name]
+                for bound, count in zip(buckets, histogram.counts):
+                    lines.append('%s_bucket{le="%s"} %d' % (name, bound, count))
+                lines += ['%s_bucket{le="+Inf"} %d' % (name, histogram.count),
+                          '%s_sum %f' % (name, histogram.sum), '%s_count %d' % (name, histogram.count)]
+        name = self.PREFIX + 'resident_memory_bytes'
+        lines += ['# HELP %s Resident memory of the daemon and its child processes.' % name,
+                  '# TYPE %s gauge' % name]
+        lines += ['%s{process="%s"} %d' % (name, process, rss) for process, rss in memory_usage() if rss is not None]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class JobTimer(object):
+    """
+    seconds spent in the stages of one scan job, also added to the metrics of the daemon
+    """
+
+    def __init__(self):
+        self.start = None
+        self.stages = {}
+        self._lock = threading.Lock()  # pages are saved by several worker threads
+
+    def begin(self):
+        self.start = time.monotonic()
+        return self
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        metrics.add_stage(stage, seconds)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, time.monotonic() - start)
+
+    def finish(self):
+        """
+        count the job as finished, return a summary of its timings for the log
+        """
+        seconds = time.monotonic() - self.start
+        metrics.inc('jobs')
+        metrics.observe('job_seconds', seconds)
+        with self._lock:
+            stages = ', '.join('%s %.3fs' % stage for stage in self.stages.items())
+        return '%.3fs (%s)' % (seconds, stages)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        content = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(address, port):
+    metrics_server = ThreadingHTTPServer((address, port), MetricsHandler)
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, name='metrics', daemon=True).start()
+    return metrics_server
+
+
+# set by the thread of a scanner that can not be served, the main thread then ends the daemon
+fatal_error = threading.Event()
+
+
+class StartupTasks(object):
+    """
+    steps of the startup, every step runs in its own thread as soon as the
+    steps it depends on are done, the time every step took is printed
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, fn, *args, depends=(), fatal=False):
+        """
+        run fn(*args) once the steps named in depends succeeded, return its future,
+        if a fatal step fails the daemon ends (see fatal_error)
+        """
+        future = self.tasks[name] = concurrent.futures.Future()
+        dependencies = [self.tasks[dependency] for dependency in depends]
+
+        def run():
+            for dependency in dependencies:
+                if dependency.exception() is not None:
+                    future.set_exception(RuntimeError('skipped, a step it depends on failed'))
+                    return
+            start = time.monotonic()
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                print("Startup step '%s' failed after %.2fs: %s" % (name, time.monotonic() - start, e),
+                      file=sys.stderr)
+                future.set_exception(e)
+                if fatal:
+                    fatal_error.set()
+            else:
+                print("Startup step '%s' took %.2fs" % (name, time.monotonic() - start))
+                future.set_result(result)
+
+        threading.Thread(target=run, name='startup: ' + name, daemon=True).start()
+        return future
+
+    def result(self, name):
+        """
+        wait for step name and return its result (raises its exception if it failed)
+        """
+        return self.tasks[name].result()
+
+
 # HTTP Post functions
 
-def post_multipart(host, selector, fields, files, exact_response=True):
+class ScannerHttpClient(object):
     """
-    Post fields and files to an http host as multipart/form-data.
-    fields is a sequence of (name, value) elements for regular form fields.
-    files is a sequence of (name, filename, value) elements for data to be uploaded as files
-    Return the server's response page.
+    keep-alive HTTP connection to the CGI of a scanner with explicit timeouts,
+    reconnects once if the scanner closed an idle connection in between
+    """
+
+    def __init__(self, host, port=80, timeout=10.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def post(self, selector, content_type, body, exact_response=True):
+        """
+        post body to selector and return the response body, or None
+        without waiting for a response if not exact_response
+        """
+        with self._lock:
+            for attempt in range(2):
+                if self._conn is None:
+                    self._conn = http_client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                    # self._conn.set_debuglevel(1)
+                try:
+                    self._conn.request('POST', selector, body, {'content-type': content_type})
+                    if not exact_response:
+                        # the scanner closes the connection without answering
+                        self.close()
+                        return None
+                    response = self._conn.getresponse()
+                    result = response.read()
+                    if response.will_close:
+                        self.close()
+                    return result
+                except (http_client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    # connection kept alive was closed by the scanner, retry with a new one
+                    self.close()
+                    if attempt:
+                        raise
+                except Exception:
+                    self.close()
+                    raise
+
+
+def post_request(http, selector, request, exact_response=True):
+    """
+    Post a request (content_type, body) as returned by encode_multipart_formdata
+    with the ScannerHttpClient http. Return the server's response page.
     """
     # t-k: print a better error message to the log
     try:
-        content_type, body = encode_multipart_formdata(fields, files)
-        h = http_client.HTTPConnection(host)
-        # h.set_debuglevel(1)
-        h.putrequest('POST', selector)
-        h.putheader('content-type', content_type)
-        h.putheader('content-length', str(len(body)))
-        h.endheaders()
-        h.send(body)
-        if exact_response:
-            response = h.getresponse()
-            return response.read()
-        else:
-            return None
+        content_type, body = request
+        return http.post(selector, content_type, body, exact_response)
     except Exception as e:
+        metrics.inc('http_errors')
         raise Exception('Problem contacting Scanner over network: %s' % e)
 
 
@@ -163,13 +522,136 @@ def encode_multipart_formdata(fields, files):
     return content_type, body
 
 
-def server_register(printing=True):
-    msg = '<?xml version="1.0" encoding="UTF-8" ?>'
-    msg += '<root>'
-    msg += '<S2PC_Regi UserID="' + SERVER_NAME + '" UniqueID="' + SERVER_UID + '" RegiType="ADD" />'
-    msg += '</root>'
+class ScannerSession(object):
+    """
+    everything belonging to one scanner served by this daemon: its address,
+    SANE handle, conversion tables, server registrations and (with
+    MODIFIED_SANE) the proxies between SANE and the scanner
+    """
+
+    def __init__(self, sane_name, conversions=None, http_port=80, snmp_port=161):
+        # SANE name of the scanner, points to the proxies if MODIFIED_SANE is used
+        self.sane_name = sane_name
+        # t-k: updated IP extraction method (thanks to frankentux)
+        #     always the real IP of the scanner, even if SANE uses the proxies
+        self.ip = extractIPs(sane_name)[0]
+        self.http_port = http_port
+        self.snmp_port = snmp_port
+        self.http = ScannerHttpClient(self.ip, http_port)
+        self.proxy_ip = None
+        # conversion tables like SIZE2SANE, missing ones are automatically configured
+        self.conversions = dict(conversions or {})
+        self.registrations = []
+        self.sane_dev = None
+        # held while sane_dev is opened, so it is opened only once
+        self.sane_lock = threading.Lock()
+        self.proxies = []
+        # control channel of the TCP proxy (with MODIFIED_SANE): this end for SANE, the other one for the proxy
+        self.control = self.proxy_control = None
+
+    def __repr__(self):
+        return "ScannerSession('%s')" % self.sane_name
+
+    def add_registration(self, name, options, owner_uid):
+        registration = ServerRegistration(self, name, options, owner_uid)
+        self.registrations.append(registration)
+        return registration
+
+    # t-k: initiate queues for communication with subprocesses and
+    #     start the proxy server processes
+    def start_proxies(self):
+        if self.control is None:
+            self.control, self.proxy_control = ProxyControl.pair()
+        while True:
+            try:
+                self.proxies = [UDProxy(self.ip, self.proxy_ip),
+                                TCProxy(self.ip, self.proxy_ip, self.proxy_control)]
+            except socket.error as e:
+                if e.errno == errno.EADDRINUSE:  # address already in use
+                    print('TCP proxy was restarted too soon, waiting 10s ...')
+                    time.sleep(10)
+                else:
+                    raise
+            else:
+                break
+        for p in self.proxies:
+            p.start()
+
+    def exit_proxies(self):
+        for p in self.proxies:
+            p.join()
+        self.proxies = []
+
+    def restart_proxies(self):
+        metrics.inc('proxy_restarts')
+        self.exit_proxies()
+        self.start_proxies()
 
-    result = str(post_multipart(SCANNER_IP, '/IDS/ScanFaxToPC.cgi', [], [(1, "c:\\IDS.XML", msg)]))
+    def page_coming(self, timeout=None):
+        """
+        ask the TCP proxy whether the scanner has another page, raises socket.timeout
+        if there is no answer within timeout seconds and EOFError if a proxy died
+        """
+        answer = self.control.request(ProxyControl.CHECK_PAGE, timeout,
+                                      alive=lambda: all(p.is_alive() for p in self.proxies))
+        return answer == ProxyControl.NEW_PAGE
+
+
+class ServerRegistration(object):
+    """
+    a server offered on the scanner panel, with its own scan options
+    and owner of the scanned files
+    """
+
+    def __init__(self, scanner, name, options, owner_uid):
+        self.scanner = scanner
+        self.name = name
+        # t-k: use md5 hashing to get real unique IDs that take into account
+        #     the whole strings rather than just the last 8 letters
+        self.uid = server_uid_gen(name)
+        self.owner_uid = owner_uid
+        self.home_dir = pwd.getpwuid(owner_uid).pw_dir
+        # every registration works on its own copy of the options, which also carries
+        #     the owner so scan_and_save knows where and for whom to save the files
+        self.options = []
+        for option in options:
+            option = dict(option)
+            option['owner_uid'] = owner_uid
+            option['homedir'] = self.home_dir
+            self.options.append(option)
+        self.instance_id = None
+        self._requests = {}
+
+    def cached_request(self, kind, key, build):
+        """
+        return the serialized request kind, built again by build() only if key
+        (identity of the server or its options) changed since the last call
+        """
+        cached = self._requests.get(kind)
+        if cached is None or cached[0] != key:
+            cached = self._requests[kind] = (key, build())
+        return cached[1]
+
+    def __repr__(self):
+        return "ServerRegistration('%s', UniqueID '%s', InstanceID %s)" % (self.name, self.uid, self.instance_id)
+
+
+def regi_request(registration, regi_type):
+    def build():
+        msg = '<?xml version="1.0" encoding="UTF-8" ?>'
+        msg += '<root>'
+        msg += '<S2PC_Regi UserID="' + registration.name + '" UniqueID="' + registration.uid + '" RegiType="' + \
+               regi_type + '" />'
+        msg += '</root>'
+        return encode_multipart_formdata([], [(1, "c:\\IDS.XML", msg)])
+
+    return registration.cached_request(regi_type, (registration.name, registration.uid), build)
+
+
+def server_register(registration, printing=True):
+    with metrics.stage('register'):
+        result = str(post_request(registration.scanner.http, '/IDS/ScanFaxToPC.cgi',
+                                  regi_request(registration, 'ADD')))
     # print result
     # <?xml version="1.0" encoding="UTF-8"?><root><S2PC_Regi UserID ="W510" Result="ADD_OK" InstanceID="29" /></root>
 
@@ -178,43 +660,44 @@ def server_register(printing=True):
         raise NameError("Error registering server: " + result)
     else:
         if printing:
-            print("Newly registered server '%(SERVER_NAME)s' with UniqueID '%(SERVER_UID)s' has got" % globals())
+            print("Newly registered server '%s' with UniqueID '%s' has got" % (registration.name, registration.uid))
             print("    InstanceID '" + m.group(1) + "'.")  # t-k: better readability and understanding
         return int(m.group(1))
 
 
 # t-k: restructered function to be real refresh
-def server_refresh():
-    global SERVER_INSTANCE_ID
-    old_instance_id = SERVER_INSTANCE_ID
-    SERVER_INSTANCE_ID = server_register(printing=False)
-    if SERVER_INSTANCE_ID != old_instance_id:
-        print("Refreshed server '%(SERVER_NAME)s' with UniqueID '%(SERVER_UID)s' has got" % globals())
-        print("    new InstanceID '" + str(SERVER_INSTANCE_ID) + "'.")
-    return SERVER_INSTANCE_ID
+def server_refresh(registration):
+    old_instance_id = registration.instance_id
+    registration.instance_id = server_register(registration, printing=False)
+    if registration.instance_id != old_instance_id:
+        print("Refreshed server '%s' with UniqueID '%s' has got" % (registration.name, registration.uid))
+        print("    new InstanceID '" + str(registration.instance_id) + "'.")
+    return registration.instance_id
 
 
 # t-k: new function = easier to understand
-def server_unregister():
-    unique_id = SERVER_UID
-    msg = '<?xml version="1.0" encoding="UTF-8" ?>'
-    msg += '<root>'
-    msg += '<S2PC_Regi UserID="' + SERVER_NAME + '" UniqueID="' + unique_id + '" RegiType="DELETE" />'
-    msg += '</root>'
-
-    result = post_multipart(SCANNER_IP, '/IDS/ScanFaxToPC.cgi', [], [(1, "c:\\IDS.XML", msg)])
+def server_unregister(registration):
+    result = post_request(registration.scanner.http, '/IDS/ScanFaxToPC.cgi', regi_request(registration, 'DELETE'))
     # print result
     # <?xml version="1.0" encoding="UTF-8"?>
     #   <root><S2PC_Regi UserID ="server" Result="DELETE_OK" InstanceID="140" /></root>
 
     m = re.match(b'.*Result="DELETE_OK"', result)
     if not m:
-        raise NameError("Error unregistering server: " + result)
+        raise NameError("Error unregistering server: %s" % result)
     else:
-        print("Unregistered server '%(SERVER_NAME)s' with UniqueID '%(SERVER_UID)s'." % globals())
+        print("Unregistered server '%s' with UniqueID '%s'." % (registration.name, registration.uid))
+
 
+def server_unregister_all(scanners):
+    for scanner in scanners:
+        for registration in scanner.registrations:
+            if registration.instance_id is not None:
+                server_unregister(registration)
+        scanner.http.close()
 
-def push_server_options():
+
+def push_server_options(registration):
     """<?xml version="1.0" encoding="UTF-8" ?>
        <root>
          <S2PC_AppList>
@@ -230,12 +713,22 @@ def push_server_options():
             <Orientation Value="ORIENTATION_SIDEWAY" />
           </List>
         </S2PC_AppList>
-     </root>"""
+     </root>
+
+       The request is built again only if the options or the server identity changed."""
+    key = (registration.name, registration.uid,
+           tuple((option["name"], option["resolution"], option["color"], option["format"], option["size"])
+                 for option in registration.options))
+    request = registration.cached_request('AppList', key, lambda: app_list_request(registration))
+    post_request(registration.scanner.http, '/IDS/ScanFaxToPC.cgi', request, False)
+
+
+def app_list_request(registration):
     root = ET.Element('root')
     app_list = ET.SubElement(root, 'S2PC_AppList')
 
     index = 0
-    for option in OPTIONS:
+    for option in registration.options:
         index += 1
         list_element = ET.SubElement(app_list, 'List')
         ET.SubElement(list_element, 'AppIndex').attrib['Value'] = str(index)
@@ -250,11 +743,14 @@ def push_server_options():
 
     msg = b'<?xml version="1.0" encoding="UTF-8" ?>\r\n' + ET.tostring(root)
     # msg=ET.tostring(root, encoding="UTF-8")
-    post_multipart(SCANNER_IP, '/IDS/ScanFaxToPC.cgi', [], [(1, "scantopc", msg)], False)
+    return encode_multipart_formdata([], [(1, "scantopc", msg)])
+
 
+USER_SELECT_REQUEST = encode_multipart_formdata([], [(1, "scantopc", "")])
 
-def query_user_options():
-    result = post_multipart(SCANNER_IP, '/IDS/UserSelect.xml', [], [(1, "scantopc", "")])
+
+def query_user_options(registration):
+    result = post_request(registration.scanner.http, '/IDS/UserSelect.xml', USER_SELECT_REQUEST)
     # {'name':'Gray-S_PDF-75','color':'GRAY','resolution':'75','format':'S_PDF','size','a4'}
     # result='<?xml version="1.0" encoding="UTF-8"?><root><S2PC_Select><AppIndex Value="1"/>
     #   <Resolution Value="DPI_300"/><Color Value="COLOR_GRAY"/><FileFormat Value="FORMAT_M_PDF"/>
@@ -263,7 +759,7 @@ def query_user_options():
     root = ET.fromstring(result).find('S2PC_Select')
     index = root.find('AppIndex').attrib["Value"]
 
-    user_options = OPTIONS[int(index) - 1]  # t-k: added '-1'
+    user_options = registration.options[int(index) - 1]  # t-k: added '-1'
     user_options['color'] = root.find('Color').attrib["Value"]
     user_options['resolution'] = root.find('Resolution').attrib["Value"]
     user_options['format'] = root.find('FileFormat').attrib["Value"]
@@ -274,30 +770,308 @@ def query_user_options():
 
 # SNMP queries
 
-def query_snmp_variable(ip, oid):
+class SnmpClient(object):
+    """
+    long-lived SNMP client that reuses one pysnmp engine and transport target
+    for all queries to a scanner, both are rebuilt after an error
+    """
+
+    def __init__(self, ip, port=161, community='public'):
+        self.ip = ip
+        self.port = port
+        self.community = community
+        self._lock = threading.Lock()
+        self._generator = self._auth = self._target = None
+
+    def _connect(self):
+        from pysnmp.entity.rfc3413.oneliner import cmdgen
+
+        self._generator = cmdgen.CommandGenerator()
+        self._auth = cmdgen.CommunityData('my-agent', self.community, 0)
+        self._target = cmdgen.UdpTransportTarget((self.ip, self.port))
+
+    def close(self):
+        self._generator = self._auth = self._target = None
+
+    def get(self, *oids):
+        """
+        query oids and return the var binds, reconnects on the next call after an error
+        """
+        with self._lock:
+            if self._generator is None:
+                self._connect()
+            try:
+                error_indication, error_status, error_index, var_binds = self._generator.getCmd(
+                    self._auth, self._target, *oids)
+            except Exception:
+                self.close()
+                raise
+            if error_indication:
+                self.close()
+                raise NameError('Error indication in SNMP query: %s' % error_indication)  # t-k: %s to avoid TypeError
+            elif error_status:
+                raise NameError('Error status in SNMP query: %s' % error_status)  # t-k: %s to avoid TypeError
+            return var_binds
+
+
+snmpClients = {}
+
+
+def get_snmp_client(ip, port=161):
+    if (ip, port) not in snmpClients:
+        snmpClients[ip, port] = SnmpClient(ip, port)
+    return snmpClients[ip, port]
+
+
+def query_snmp_variable(ip, *oids, port=161):
+    return get_snmp_client(ip, port).get(*oids)
+
+
+def benchmark_snmp(scanner, count):
+    """
+    compare queries/sec of building the pysnmp machinery for every query
+    (as done before) with the persistent SnmpClient and the fast path,
+    querying the SNMP port of the ScannerSession scanner
+    """
     from pysnmp.entity.rfc3413.oneliner import cmdgen
 
-    error_indication, error_status, error_index, var_binds = cmdgen.CommandGenerator().getCmd(
-        cmdgen.CommunityData('my-agent', 'public', 0),
-        cmdgen.UdpTransportTarget((ip, 161)),
-        oid)
+    oid = (1, 3, 6, 1, 2, 1, 1, 1, 0)  # sysDescr, an OctetString answered by every SNMP agent
 
-    return_value = None
-    if error_indication:
-        raise NameError('Error indication in SNMP query: %s' % error_indication)  # t-k: %s to avoid TypeError
-    elif error_status:
-        raise NameError('Error status in SNMP query: %s' % error_status)  # t-k: %s to avoid TypeError
-    else:
-        return_value = var_binds
-    return return_value
+    def query_with_new_engine():
+        cmdgen.CommandGenerator().getCmd(cmdgen.CommunityData('my-agent', 'public', 0),
+                                         cmdgen.UdpTransportTarget((scanner.ip, scanner.snmp_port)), oid)
 
+    client = SnmpClient(scanner.ip, scanner.snmp_port)
+    raw_client = RawSnmpClient(scanner.ip, scanner.snmp_port)
+    for name, query in [('new engine per query', query_with_new_engine),
+                        ('persistent client', lambda: client.get(oid)),
+                        ('fast path', lambda: raw_client.get_octet_strings(oid))]:
+        start = time.perf_counter()
+        for _ in range(count):
+            query()
+        elapsed = time.perf_counter() - start
+        print('SNMP benchmark: %-20s %8.1f queries/s (%d queries in %.2fs)' % (name, count / elapsed, count, elapsed))
 
-def query_printer_scan_status(instance_id):
+
+# Minimal BER codec for SNMPv1 GET requests: the daemon only ever reads OctetString
+#     values of the scan status OID, so a precomputed request and a tiny parser for the
+#     reply replace the pysnmp stack on the fast path
+
+SCAN_STATUS_OID = (1, 3, 6, 1, 4, 1, 236, 11, 5, 11, 81, 11, 7, 2, 1, 2)
+
+BER_INTEGER = 0x02
+BER_OCTET_STRING = 0x04
+BER_NULL = 0x05
+BER_OID = 0x06
+BER_SEQUENCE = 0x30
+SNMP_GET_REQUEST = 0xa0
+SNMP_GET_RESPONSE = 0xa2
+
+
+def ber_encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(length_bytes)]) + length_bytes
+
+
+def ber_encode(tag, content):
+    return bytes([tag]) + ber_encode_length(len(content)) + content
+
+
+def ber_encode_oid(oid):
+    content = bytearray([40 * oid[0] + oid[1]])
+    for sub_id in oid[2:]:
+        chunk = [sub_id & 0x7f]
+        sub_id >>= 7
+        while sub_id:
+            chunk.append(0x80 | (sub_id & 0x7f))
+            sub_id >>= 7
+        content.extend(reversed(chunk))
+    return ber_encode(BER_OID, bytes(content))
+
+
+def ber_decode_oid(content):
+    if not content:
+        raise ValueError('empty OID')
+    oid = list(divmod(content[0], 40)) if content[0] < 80 else [2, content[0] - 80]
+    sub_id = 0
+    for byte in content[1:]:
+        sub_id = (sub_id << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            oid.append(sub_id)
+            sub_id = 0
+    return tuple(oid)
+
+
+def ber_read(data, offset, expected_tag=None):
+    """
+    read the TLV at offset, return (tag, start of content, end of content)
+    """
+    if offset + 2 > len(data):
+        raise ValueError('truncated BER data at offset %d' % offset)
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        nr_bytes = length & 0x7f
+        if not 0 < nr_bytes <= 4 or offset + nr_bytes > len(data):
+            raise ValueError('invalid BER length at offset %d' % offset)
+        length = int.from_bytes(data[offset:offset + nr_bytes], 'big')
+        offset += nr_bytes
+    if offset + length > len(data):
+        raise ValueError('truncated BER data at offset %d' % offset)
+    if expected_tag is not None and tag != expected_tag:
+        raise ValueError('unexpected BER tag 0x%02x (expected 0x%02x)' % (tag, expected_tag))
+    return tag, offset, offset + length
+
+
+def snmp_encode_get_request(community, oids, request_id=0):
+    """
+    return (request, offset of the request id) for an SNMPv1 GET of oids,
+    the request id is encoded with a fixed width of 4 bytes so it can be
+    patched in place for every request
+    """
+    var_binds = b''.join(ber_encode(BER_SEQUENCE, ber_encode_oid(oid) + b'\x05\x00') for oid in oids)
+    pdu_header = b'\x02\x04' + request_id.to_bytes(4, 'big')
+    pdu = ber_encode(SNMP_GET_REQUEST, pdu_header + b'\x02\x01\x00\x02\x01\x00' + ber_encode(BER_SEQUENCE, var_binds))
+    message_header = ber_encode(BER_INTEGER, b'\x00') + ber_encode(BER_OCTET_STRING, community)
+    request = ber_encode(BER_SEQUENCE, message_header + pdu)
+    request_id_offset = request.index(pdu_header, len(request) - len(pdu)) + 2
+    return request, request_id_offset
+
+
+def snmp_decode_get_response(data):
+    """
+    decode an SNMPv1 GetResponse, return (request id, error status, [(oid, tag, value), ...])
+    """
+    _, offset, end = ber_read(data, 0, BER_SEQUENCE)
+    _, start, offset = ber_read(data, offset, BER_INTEGER)  # version
+    _, start, offset = ber_read(data, offset, BER_OCTET_STRING)  # community
+    _, offset, end = ber_read(data, offset, SNMP_GET_RESPONSE)
+    _, start, offset = ber_read(data, offset, BER_INTEGER)
+    request_id = int.from_bytes(data[start:offset], 'big', signed=True)
+    _, start, offset = ber_read(data, offset, BER_INTEGER)
+    error_status = int.from_bytes(data[start:offset], 'big', signed=True)
+    _, start, offset = ber_read(data, offset, BER_INTEGER)  # error index
+    _, offset, end = ber_read(data, offset, BER_SEQUENCE)
+    var_binds = []
+    while offset < end:
+        _, var_bind_start, offset = ber_read(data, offset, BER_SEQUENCE)
+        _, start, value_start = ber_read(data, var_bind_start, BER_OID)
+        oid = ber_decode_oid(data[start:value_start])
+        tag, start, value_end = ber_read(data, value_start)
+        var_binds.append((oid, tag, bytes(data[start:value_end])))
+    return request_id, error_status, var_binds
+
+
+def snmp_request_id(data):
+    """
+    return the request id of an SNMPv1/v2c message of any PDU type,
+    None if data is no such message (e.g. SNMPv3)
+    """
+    try:
+        _, offset, end = ber_read(data, 0, BER_SEQUENCE)
+        _, start, offset = ber_read(data, offset, BER_INTEGER)  # version
+        _, start, offset = ber_read(data, offset, BER_OCTET_STRING)  # community
+        _, offset, end = ber_read(data, offset)  # PDU
+        _, start, offset = ber_read(data, offset, BER_INTEGER)
+    except ValueError:
+        return None
+    return int.from_bytes(data[start:offset], 'big', signed=True)
+
+
+class RawSnmpClient(object):
+    """
+    SNMPv1 GET client on a plain UDP socket for OctetString values,
+    the encoded requests are cached per set of OIDs
+    """
+
+    def __init__(self, ip, port=161, community=b'public', timeout=1.0):
+        self.address = (ip, port)
+        self.community = community
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._request_id = 0
+        self._sock = None
+        self.failed = False  # last query fell back to pysnmp
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def get_octet_strings(self, *oids):
+        """
+        query oids and return their OctetString values in the same order
+        """
+        with self._lock:
+            if oids not in self._requests:
+                request, offset = snmp_encode_get_request(self.community, oids)
+                self._requests[oids] = (bytearray(request), offset)
+            request, offset = self._requests[oids]
+            self._request_id = (self._request_id + 1) & 0x7fffffff
+            request[offset:offset + 4] = self._request_id.to_bytes(4, 'big')
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._sock.settimeout(self.timeout)
+                self._sock.connect(self.address)
+            try:
+                self._sock.send(request)
+                while True:
+                    request_id, error_status, var_binds = snmp_decode_get_response(self._sock.recv(1500))
+                    # skip late replies to earlier (timed out) requests
+                    if request_id == self._request_id:
+                        break
+            except Exception:
+                self.close()
+                raise
+        if error_status:
+            raise NameError('Error status in SNMP query: %s' % error_status)
+        if tuple(oid for oid, tag, value in var_binds) != oids:
+            raise ValueError('SNMP reply does not match the requested OIDs')
+        values = []
+        for oid, tag, value in var_binds:
+            if tag != BER_OCTET_STRING:
+                raise ValueError('SNMP value of %s is not an OctetString (tag 0x%02x)' % (oid, tag))
+            values.append(value)
+        return values
+
+
+rawSnmpClients = {}
+
+
+def get_raw_snmp_client(ip, port=161):
+    if (ip, port) not in rawSnmpClients:
+        rawSnmpClients[ip, port] = RawSnmpClient(ip, port)
+    return rawSnmpClients[ip, port]
+
+
+def query_printer_scan_statuses(scanner, instance_ids):
+    """
+    query the scan status of all instance_ids with a single SNMP GET,
+    return the statuses in the same order
+    """
+    oids = tuple(SCAN_STATUS_OID + (instance_id,) for instance_id in instance_ids)
+    metrics.inc('snmp_polls')
+    if SNMP_FAST_PATH:
+        client = get_raw_snmp_client(scanner.ip, scanner.snmp_port)
+        try:
+            statuses = [value[0] for value in client.get_octet_strings(*oids)]
+        except Exception as e:
+            # fall back to pysnmp, which also reports errors in more detail
+            if not client.failed:
+                print('SNMP fast path failed (%s), falling back to pysnmp.' % e, file=sys.stderr)
+            client.failed = True
+        else:
+            client.failed = False
+            return statuses
     # t-k: more descriptive Error handling and logging
     try:
-        result = query_snmp_variable(SCANNER_IP, (1, 3, 6, 1, 4, 1, 236, 11, 5, 11, 81, 11, 7, 2, 1, 2, instance_id))
-        # (ObjectName('1.3.6.1.4.1.236.11.5.11.81.11.7.2.1.2.29'), OctetString('\x00\x00\x00\x00'))
-        return result[0][1][0]
+        result = query_snmp_variable(scanner.ip, *oids, port=scanner.snmp_port)
+        # [(ObjectName('1.3.6.1.4.1.236.11.5.11.81.11.7.2.1.2.29'), OctetString('\x00\x00\x00\x00')), ...]
+        return [var_bind[1][0] for var_bind in result]
     except Exception as e:
         if 'result' not in locals():
             result = None
@@ -306,68 +1080,228 @@ def query_printer_scan_status(instance_id):
                          "Error message: %(e)s.") % locals())
 
 
-# Function for a single scan task
-def scann_worker():
-    server_refresh()
+# Asynchronous control plane: registration refresh, SNMP status polling and the
+#     HTTP requests to the scanner run as tasks with real timers instead of a
+#     blocking loop that sleeps for a second between two polls
+
+class StatusPoller(object):
+    """
+    polls the printer scan status of all registrations of a scanner with one SNMP GET and
+    an adaptive interval: fast polls right after the panel showed activity,
+    slow polls while the scanner is idle
+    """
+
+    def __init__(self, scanner, idle_interval, active_interval, active_timeout):
+        self.scanner = scanner
+        self.registrations = scanner.registrations
+        self.idle_interval = idle_interval
+        self.active_interval = active_interval
+        self.active_timeout = active_timeout
+        self.last_statuses = None
+        self.last_activity = None
+
+    def mark_active(self):
+        self.last_activity = time.monotonic()
+
+    def interval(self):
+        """
+        return seconds to wait until the next poll
+        """
+        if self.last_activity is not None and time.monotonic() - self.last_activity < self.active_timeout:
+            return self.active_interval
+        return self.idle_interval
+
+    async def poll(self):
+        """
+        return a dictionary of registration -> scan status
+        """
+        instance_ids = [registration.instance_id for registration in self.registrations]
+        statuses = await asyncio.to_thread(query_printer_scan_statuses, self.scanner, instance_ids)
+        # any status change or a pending job counts as activity on the panel
+        if any(statuses) or (self.last_statuses is not None and statuses != self.last_statuses):
+            self.mark_active()
+        self.last_statuses = statuses
+        return dict(zip(self.registrations, statuses))
+
+    async def wait_for(self, wanted, registrations=None):
+        """
+        poll until one of registrations (default: all) has a scan status in wanted,
+        return (registration, status)
+        """
+        while True:
+            statuses = await self.poll()
+            for registration in registrations or self.registrations:
+                if statuses[registration] in wanted:
+                    return registration, statuses[registration]
+            await asyncio.sleep(self.interval())
+
+
+async def refresh_periodically(registrations, interval):
+    # refresh every > 5 mins (server get's auto. unregistered after ~30 mins)
+    while True:
+        await asyncio.sleep(interval)
+        for registration in registrations:
+            await asyncio.to_thread(server_refresh, registration)
+
+
+async def wait_for_user_selection(scanner, timer):
+    poller = StatusPoller(scanner, POLL_INTERVAL_IDLE, POLL_INTERVAL_ACTIVE, POLL_ACTIVE_TIMEOUT)
 
     # t-k: a little more descriptive logging
     print("Waiting for scan job ...")
-    # print ' '*4 + 'printer scan status: ' + str(query_printer_scan_status(SERVER_INSTANCE_ID)) + ' -- waiting for 1
-    # ...'
-    i = 0
-    while query_printer_scan_status(SERVER_INSTANCE_ID) != 1:
-        i += 1
-        if i % 300 == 0:  # t-k: refresh every > 5 mins (server get's auto. unregistered after ~30 mins)
-            server_refresh()
-        time.sleep(1)
-    print(' ' * 4 + 'Got it!')
+    with metrics.stage('wait_selected'):
+        registration, status = await poller.wait_for((1,))
+    print(' ' * 4 + "Got it for server '%s'!" % registration.name)
+    # the job starts when the server was selected on the panel
+    timer.begin()
 
-    push_server_options()
+    with timer.stage('push_options'):
+        await asyncio.to_thread(push_server_options, registration)
 
     # t-k: a little more descriptive logging
     print("Waiting for user selection ...")
-    # print ' '*4 + 'printer scan status: ' + str(query_printer_scan_status(SERVER_INSTANCE_ID)) + ' -- waiting for 2
-    # ...'
-
     # t-k: may be canceled by user: check if status changes back to 1
-    i = 0
     while True:
-        pps = query_printer_scan_status(SERVER_INSTANCE_ID)
-        if pps == 2:
+        with timer.stage('wait_user_selection'):
+            status = (await poller.wait_for((1, 2), [registration]))[1]
+        if status != 1:
             break
-        elif pps == 1:
-            push_server_options()
-            print('Reconnected, waiting for user selection ...')
-            # print ' '*4 + 'printer scan status: ' + str(query_printer_scan_status(SERVER_INSTANCE_ID)) + ' --
-            # waiting for 2 ...'
-            continue
-        i += 1
-        if i % 300 == 0:
-            server_refresh()
-        time.sleep(1)
+        with timer.stage('push_options'):
+            await asyncio.to_thread(push_server_options, registration)
+        print('Reconnected, waiting for user selection ...')
     print(' ' * 4 + 'Got it!')
 
-    user_selection = query_user_options()
-    print('Options selected by user:', user_selection)
+    with timer.stage('query_user_options'):
+        return registration, await asyncio.to_thread(query_user_options, registration)
+
+
+async def scan_session(scanner, timer):
+    """
+    wait for a scan job on the scanner panel while keeping the registrations
+    fresh, return the chosen registration and the options selected by the user
+    """
+    for registration in scanner.registrations:
+        await asyncio.to_thread(server_refresh, registration)
+
+    selection = asyncio.ensure_future(wait_for_user_selection(scanner, timer))
+    refresher = asyncio.ensure_future(refresh_periodically(scanner.registrations, SERVER_REFRESH_INTERVAL))
+    try:
+        await asyncio.wait([selection, refresher], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        selection.cancel()
+        refresher.cancel()
+    # a failed refresh aborts the session like any other network problem
+    if refresher.done() and not refresher.cancelled():
+        refresher.result()
+    return selection.result()
+
+
+# Function for a single scan task
+def scann_worker(scanner):
+    timer = JobTimer()
+    registration, user_selection = asyncio.run(scan_session(scanner, timer))
+    print("Options selected by user of server '%s':" % registration.name, user_selection)
+
+    return scan_and_save(user_selection, scanner=scanner, timer=timer)
+
 
-    scan_and_save(user_selection)
+class DiscoveryCache(object):
+    """
+    results of the slow automatic configuration (SANE device discovery, conversion
+    tables like SIZE2SANE) kept between restarts in a JSON file, every entry carries
+    the ETag and hash of the CAP.XML of its scanner to tell whether it is still valid
+    """
+    VERSION = 1
+
+    def __init__(self, path, ignore_saved=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path and not ignore_saved:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self.entries = data['entries']
+            except (OSError, ValueError, KeyError, AttributeError):
+                pass
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            if not self.path:
+                return
+            try:
+                # write the whole file aside and replace the old one, so it is never half written
+                tmp_path = '%s.%d' % (self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump({'version': self.VERSION, 'entries': self.entries}, f, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print("Could not write discovery cache '%s': %s" % (self.path, e), file=sys.stderr)
+
+    def valid(self, entry, ip, http_port, timeout=10.0):
+        """
+        check whether entry is still valid for the scanner at ip, returns False if the
+        scanner does not answer or its CAP.XML changed
+        """
+        if not entry or 'cap_sha256' not in entry:
+            return False
+        try:
+            cap = fetch_cap_xml(ip, http_port, entry.get('cap_etag'), timeout)
+        except Exception:
+            return False
+        return cap is None or cap[0] == entry['cap_sha256']
+
+
+def fetch_cap_xml(ip, http_port=80, etag=None, timeout=10.0):
+    """
+    fetch /IDS/CAP.XML of the scanner and return (sha256 hex digest, ETag or None, data),
+    None if it still has the given etag
+    """
+    req = request.Request('http://%s:%d/IDS/CAP.XML' % (ip, http_port))
+    if etag:
+        req.add_header('If-None-Match', etag)
+    try:
+        capxmlfile = request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:  # not modified
+            return None
+        raise
+    with capxmlfile:
+        data = capxmlfile.read()
+        return hashlib.sha256(data).hexdigest(), capxmlfile.headers.get('ETag'), data
+
+
+class ConfigError(Exception):
+    """
+    a setting is missing and can not be found automatically, the daemon can not go on
+    """
 
 
 # t-k: method to automatically determine translation from scanner command (received by server) to sane command
 #     was written for sizes but may be adapted to other translations
-def autoconfig_dic(dic_name, xml_key, preferred):
-    if dic_name not in globals():
+def autoconfig_dic(scanner, dic_name, xml_key, preferred, device=None):
+    if dic_name not in scanner.conversions:
+        cache_key = '%s %s' % (dic_name, scanner.sane_name)
+        entry = discovery_cache.get(cache_key)
+        if discovery_cache.valid(entry, scanner.ip, scanner.http_port):
+            scanner.conversions[dic_name] = entry[dic_name]
+            print_autoconfig(entry[dic_name], dic_name + ' (cached)', no_quotes=True)
+            return
         try:
             # t-k: get available options from XML file that may be received by server
-            capxmlfile = request.urlopen('http://%s/IDS/CAP.XML' % REAL_SCANNER_IP)
-            capxmldata = capxmlfile.read()
-            capxmlfile.close()
+            cap_sha256, cap_etag, capxmldata = fetch_cap_xml(scanner.ip, scanner.http_port)
             xmlroot = ET.fromstring(capxmldata)
             sizes = []
             for size in xmlroot.iter(xml_key):
                 sizes.append(size.attrib['ID'])
             # t-k: get available size options for SANE device
-            sane_sizes = saneSingleton["page_format"].constraint
+            sane_sizes = (scanner.sane_dev if device is None else device)["page_format"].constraint
             # t-k: match these two sets together and save as dic_name (e.g. SIZE2SANE)
             dic = {}
             for sizeID in sizes:
@@ -383,71 +1317,452 @@ def autoconfig_dic(dic_name, xml_key, preferred):
                         dic[sizeID] = saneSize
             if dic == {}:
                 raise ValueError('%(dic_name)s dictionary must not be empty!' % locals())
-            globals()[dic_name] = dic
+            scanner.conversions[dic_name] = dic
             print_autoconfig(dic, dic_name, no_quotes=True)
+            discovery_cache.set(cache_key, {'cap_sha256': cap_sha256, 'cap_etag': cap_etag, dic_name: dic})
         except Exception as e:
             print('Error while trying to configure scanning options:', file=sys.stderr)
             print('    %s: %s' % (type(e).__name__, e), file=sys.stderr)
             print("You should manually configure %s in '%s'." % (dic_name, CONFIG_FILE), file=sys.stderr)
-            sys.exit(1)
+            raise ConfigError('%s could not be configured automatically' % dic_name) from e
+
+
+def import_sane():
+    """
+    import python-sane on first use, return the module
+    """
+    global sane
+    if sane is None:
+        import sane
+    return sane
+
+
+# angelnu: my scanner takes very long to find -> cache (per scanner in ScannerSession.sane_dev)
+#     SANE itself is shared by all scanners, so only one of them initializes or opens a device at a time,
+#     waiting before trying again does not hold the lock
+saneLock = threading.Lock()
+
+
+def get_sane_instance(scanner):
+    with scanner.sane_lock:
+        if scanner.sane_dev:
+            return scanner.sane_dev
+        print("Init SANE ...")
+        with saneLock:
+            import_sane().init()
+
+        print("Connecting to scanner " + scanner.sane_name + " ...")
+        mixins = ()
+        if SCAN_BAND_LINES:
+            if band_snap_supported():
+                mixins = (BandSaneDev,)
+            else:
+                print('python-sane %s reads pages only as a whole, ignoring SCAN_BAND_LINES'
+                      % getattr(sane, '__version__', '< 2.9'), file=sys.stderr)
+        while True:
+            try:
+                with saneLock:
+                    # t-k: use modified open method to use modified sane classes
+                    if MODIFIED_SANE:
+                        device = modsaneopen(scanner.sane_name, scanner, mixins)
+                    elif mixins:
+                        device = sane_subclass('SaneDev', *mixins)(scanner.sane_name)
+                    else:
+                        device = sane.open(scanner.sane_name)
+            except Exception as e:
+                if MODIFIED_SANE and str(e).startswith('no such scan device'):
+                    print("Proxy scan 'device' not found, restarting proxies and trying again ...", file=sys.stderr)
+                    # t-k: restart proxies
+                    scanner.restart_proxies()
+                else:
+                    print('Problem connecting to scanner, trying again in 10s ...', file=sys.stderr)
+                    traceback.print_exc(file=sys.stderr)
+                    time.sleep(10)
+            else:
+                # t-k: if SIZE2SANE / ... haven't been given in config file, try to automatically configure them
+                # t-k: f.l.t.r. -> name of dict, xml key, preferred sane option
+                #     (raises ConfigError if that fails, the device is only kept if it succeeded)
+                autoconfig_dic(scanner, 'SIZE2SANE', 'Size', 'rotated', device)
+                scanner.sane_dev = device
+                break
+
+        print("Connected to scanner.")
+        return scanner.sane_dev
+
+
+# User filters: by default they run in the page worker threads, with FILTER_PROCESSES > 0
+#     in a pool of processes that stays warm between jobs (filters written in Python hold the GIL)
+
+def apply_filters(im, filters):
+    """
+    apply the filter chain to im, return the filtered image and
+    a list of (filter name, seconds spent in the filter)
+    """
+    timings = []
+    for user_filter in filters:
+        start = time.perf_counter()
+        im = user_filter(im)
+        timings.append((getattr(user_filter, '__name__', repr(user_filter)), time.perf_counter() - start))
+    return im, timings
+
+
+# pages are sent to and from the filter processes as (mode, size, raw pixel data)
+def pack_image(im):
+    return im.mode, im.size, im.tobytes()
+
+
+def unpack_image(packed):
+    from PIL import Image
+    mode, size, data = packed
+    return Image.frombytes(mode, size, data)
+
+
+def apply_filters_packed(packed, filters):
+    im, timings = apply_filters(unpack_image(packed), filters)
+    return pack_image(im), timings
+
+
+filterPool = None
+filterPoolLock = threading.Lock()
+
+
+def start_filter_pool(initializer=None, initargs=()):
+    """
+    start the FILTER_PROCESSES filter processes, the daemon does this at startup before
+    it runs other threads: the processes are forked (so filters defined in the configuration
+    file are known to them) and a fork copies the locks other threads hold at that moment
+    """
+    global filterPool
+    with filterPoolLock:
+        if filterPool is None:
+            filterPool = concurrent.futures.ProcessPoolExecutor(
+                FILTER_PROCESSES, mp_context=multiprocessing.get_context('fork'),
+                initializer=initializer, initargs=initargs)
+            # all processes are forked with the first task
+            filterPool.submit(int).result()
+        return filterPool
+
+
+def run_filters(im, filters):
+    if FILTER_PROCESSES:
+        try:
+            pickle.dumps(filters)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            # e.g. lambdas or nested functions can not be sent to other processes
+            print('Could not run user filters in filter processes (%s), running them here.' % e, file=sys.stderr)
+        else:
+            future = start_filter_pool().submit(apply_filters_packed, pack_image(im), filters)
+            packed, timings = future.result()
+            return unpack_image(packed), timings
+    return apply_filters(im, filters)
+
+
+# orientation tag (EXIF/TIFF) telling viewers to display the image rotated by 90 degrees clockwise
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_ROTATE_90_CW = 6
+
+
+def encoder_profile(user_selection):
+    """
+    return (bilevel, Pillow save parameters) of the encoder profile of the option user_selection,
+    its 'encoder' or else the one ENCODER_DEFAULTS gives for its color
+    """
+    name = user_selection.get('encoder') or ENCODER_DEFAULTS.get(user_selection['color'], 'pillow')
+    if name not in ENCODER_PROFILES:
+        print("Unknown encoder profile '%s', using Pillow's defaults." % name, file=sys.stderr)
+        return False, {}
+    params = dict(ENCODER_PROFILES[name])
+    return params.pop('bilevel', False), params
+
+
+# Pillow save parameters only used for JPEG data
+JPEG_PARAMS = ('quality', 'subsampling', 'optimize', 'progressive')
+
+
+def save_params_for(mode, params, extension):
+    """
+    return params without the JPEG parameters for 1 bit images (mode '1') in PDF and TIFF files,
+    these store them with CCITT Group 4 (and Pillow refuses JPEG parameters for it)
+    """
+    if mode != '1' or extension in ('jpg', 'jpeg'):
+        return params
+    return {key: value for key, value in params.items() if key not in JPEG_PARAMS}
+
+
+def to_bilevel(im):
+    """
+    return im as 1 bit image (threshold at half intensity, no dithering),
+    PDF and TIFF files can store these with CCITT Group 4
+    """
+    from PIL import Image
+    if im.mode == '1':
+        return im
+    return im.convert('L').convert('1', dither=Image.Dither.NONE)
+
+
+class OutputIndex(object):
+    """
+    in-memory index of the base names (file names without extension) taken in
+    the output directories: every directory is scanned once with os.scandir,
+    afterwards a free ${uid} is found without listing the directory again
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._taken = {}  # directory -> set of base names
+        self._next_index = {}  # key -> next ${uid} to try
+
+    def scan(self, directory):
+        """
+        return the set of base names taken in directory, scanned on first use
+        """
+        taken = self._taken.get(directory)
+        if taken is None:
+            taken = set()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        # t-k: raise index independent of file extension (all of 'a', 'a.b' for 'a.b.c')
+                        parts = entry.name.split('.')
+                        for i in range(1, len(parts)):
+                            taken.add('.'.join(parts[:i]))
+            except FileNotFoundError:
+                pass
+            self._taken[directory] = taken
+        return taken
+
+    def allocate(self, key, make_base_filename, extension):
+        """
+        return the file name for the first ${uid} whose base name make_base_filename(uid)
+        is free and reserve it, searching starts after the ${uid} allocated last for key
+        """
+        with self._lock:
+            index = self._next_index.get(key, 1)
+            while True:
+                base_filename = make_base_filename(index)
+                index += 1
+                directory, base_name = os.path.split(base_filename)
+                taken = self.scan(directory)
+                if base_name in taken:
+                    continue
+                taken.add(base_name)
+                # files created by someone else since the scan (e.g. the web UI) take it with any extension
+                if glob.glob(glob.escape(base_filename) + '.*'):
+                    continue
+                self._next_index[key] = index
+                return base_filename + '.' + extension
+
+
+outputIndex = OutputIndex()
+
+
+def image_bytes(im):
+    """
+    memory Pillow takes for the pixels of the page im (modes '1', 'L' and 'RGB')
+    """
+    return im.width * im.height * (1 if im.mode in ('1', 'L', 'P') else 4)
+
+
+class MemoryBudget(object):
+    """
+    bytes of page images a scan job may hold in memory (limit None: no limit),
+    taken and given back by the scanning thread and the page workers
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.spilled = 0
+        self._lock = threading.Lock()
+
+    def take(self, size, always=False):
+        """
+        take size bytes if they fit into the budget (or always, for memory already
+        in use), return whether they did
+        """
+        with self._lock:
+            if not always and self.limit is not None and self.used + size > self.limit:
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def give_back(self, size):
+        with self._lock:
+            self.used -= size
+
+
+class SpilledImage(object):
+    """
+    page image moved to a memory-mapped temporary file in directory (MEMORY_SPILL_DIR),
+    the kernel reads it back as needed and may drop it from memory at any time.
+    The file is deleted at once, the mapping keeps it until the page is no longer used.
+    """
+
+    BAND_LINES = 256
+
+    def __init__(self, im, directory=None):
+        self.mode = im.mode
+        self.size = im.size
+        with tempfile.TemporaryFile(prefix='samsungScannerServer-', dir=directory) as f:
+            # in bands: no copy of the whole page
+            for top in range(0, im.height, self.BAND_LINES):
+                f.write(im.crop((0, top, im.width, min(im.height, top + self.BAND_LINES))).tobytes())
+            f.flush()
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
+    def load(self):
+        """
+        return the page as image again, 'L' pages are used right from the file (read-only image),
+        other pages are read back into memory
+        """
+        from PIL import Image
+        return Image.frombuffer(self.mode, self.size, self._map, 'raw', self.mode, 0, 1)
 
-# angelnu: my scanner takes very long to find -> cache
-saneSingleton = None
 
+class MultiPagePdf(object):
+    """
+    multi-page PDF written while scanning: with method 'append' every page is
+    encoded and appended to the file as soon as it is done (only one page is
+    held in memory), with method 'save_all' the pages are collected and written
+    with Pillow's save_all/append_images when the document is closed, or as
+    soon as the pages would exceed the MemoryBudget budget, then the following
+    pages are appended
+    """
 
-def get_sane_instance():
-    global saneSingleton
-    if saneSingleton:
-        return saneSingleton
-    else:
-        print("Init SANE ...")
-        sane.init()
+    def __init__(self, filename, dpi, method='append', params=None, budget=None):
+        self.filename = filename
+        self.dpi = dpi
+        self.method = method
+        # Pillow save parameters of the encoder profile
+        self.params = params or {}
+        self.budget = budget or MemoryBudget()
+        self.nr_pages = 0
+        self._pages = []
+
+    def add_page(self, im):
+        self.nr_pages += 1
+        if self.method == 'save_all':
+            if self.budget.take(image_bytes(im)):
+                self._pages.append(im)
+                return
+            print("Memory budget of the job reached, writing the pages so far and appending the next ones ...")
+            self.method = 'append'
+            self._write_pages()
+        print("Writing page %d of %s ..." % (self.nr_pages, self.filename))
+        im.save(self.filename, 'PDF', resolution=self.dpi, append=self.nr_pages > 1,
+                **save_params_for(im.mode, self.params, 'pdf'))
+
+    def _write_pages(self):
+        if self._pages:
+            print("Writing %d pages to %s ..." % (len(self._pages), self.filename))
+            # the parameters apply to all pages
+            params = self.params
+            if any(im.mode == '1' for im in self._pages):
+                params = save_params_for('1', params, 'pdf')
+            self._pages[0].save(self.filename, 'PDF', resolution=self.dpi, save_all=True,
+                                append_images=self._pages[1:], **params)
+            self.budget.give_back(sum(image_bytes(im) for im in self._pages))
+            self._pages = []
+
+    def close(self):
+        self._write_pages()
+
+
+def process_pages(pages, prepare, process, depth=None, workers=None):
+    """
+    bounded producer/consumer pipeline for scanned pages: one thread pulls
+    pages from the iterator pages (i.e. scans) while a pool of workers runs
+    process(prepare(page)) on the pages pulled before. prepare runs in page
+    order in the calling thread, the results are yielded in page order.
+    At most depth pages wait in the queue behind the scanner, one more is
+    handed over by the scanning thread and at most depth pages are processed
+    or wait to be yielded: up to 2 * depth + 1 pages in all.
+    An exception of pages is raised after the pages pulled before it are done.
+    The scanning thread is done with pages when this returns or raises, unless
+    it is stuck for longer than PAGE_QUERY_TIMEOUT seconds.
+    """
+    depth = max(1, depth or PAGE_QUEUE_DEPTH)
+    page_q = queue.Queue(depth)
+    stop = threading.Event()
 
-        print("Connecting to scanner ...")
-        while True:
+    def put(item):
+        while not stop.is_set():
             try:
-                # t-k: use modified open method to use modified sane classes
-                if MODIFIED_SANE:
-                    saneSingleton = modsaneopen(SCANNER_SANE_NAME)
-                else:
-                    saneSingleton = sane.open(SCANNER_SANE_NAME)
-            except Exception as e:
-                if MODIFIED_SANE and e.message.startswith('no such scan device'):
-                    print("Proxy scan 'device' not found, restarting proxies and trying again ...", file=sys.stderr)
-                    # t-k: restart proxies
-                    exit_proxies()
-                    start_proxies()
-                else:
-                    print('Problem connecting to scanner, trying again in 10s ...', file=sys.stderr)
-                    traceback.print_exc(file=sys.stderr)
-                    time.sleep(10)
-            else:
-                # t-k: if SIZE2SANE / ... haven't been given in config file, try to automatically configure them
-                # t-k: f.l.t.r. -> name of dict, xml key, preferred sane option
-                autoconfig_dic('SIZE2SANE', 'Size', 'rotated')
-                break
+                page_q.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put(('page', page)):
+                    return
+        except Exception as e:
+            put(('error', e))
+        else:
+            put(('end', None))
+
+    producer = threading.Thread(target=produce, name='page producer', daemon=True)
+    producer.start()
+    pending = collections.deque()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers or PAGE_WORKERS) as executor:
+            while True:
+                kind, item = page_q.get()
+                if kind != 'page':
+                    break
+                pending.append(executor.submit(process, prepare(item)))
+                while len(pending) >= depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        if kind == 'error':
+            raise item
+    finally:
+        stop.set()
+        for future in pending:
+            future.cancel()
+        # pages may still be in the middle of a scan: the next use of the SANE device has to wait for it
+        producer.join(PAGE_QUERY_TIMEOUT)
+        if producer.is_alive():
+            print('Scanning thread still busy after %ds, going on without it' % PAGE_QUERY_TIMEOUT, file=sys.stderr)
+
+
+def scan_and_save(user_selection, imgs=None, scanner=None, timer=None):
+    """
+    scan with scanner (or process imgs instead) and save the pages as selected by the user,
+    return the names of the files written. The stages are timed with the JobTimer timer.
+    """
+    with peak_rss.job() as peak:
+        return scan_and_save_pages(user_selection, imgs, scanner, timer, peak)
 
-        print("Connected to scanner.")
-        return saneSingleton
 
+def scan_and_save_pages(user_selection, imgs, scanner, timer, peak):
+    """
+    scan_and_save() as a job of peak_rss, peak() describes the peak RSS of the job
+    """
+    from PIL import Image
 
-def scan_and_save(user_selection, imgs=None):
-    global saneSingleton  # t-k: if cache needs to be reset
+    if timer is None:
+        timer = JobTimer().begin()
+    # pages beyond MEMORY_BUDGET wait in temporary files, multi-page PDFs are written early
+    budget = MemoryBudget(MEMORY_BUDGET << 20 if MEMORY_BUDGET else None)
 
-    # t-k: to raise file index independent of file extension
-    #     so no more same file names with different extensions
-    def exists_file_with_other_extension(base_filename):
-        from glob import glob
-        search_pattern = base_filename + '.*'
-        return bool(glob(search_pattern))
+    # options of a registration carry their owner, plain OPTIONS (debug mode) use the global settings
+    owner_uid = user_selection.get('owner_uid', globals().get('OWNER_UID'))
+    home_dir = user_selection.get('homedir', HOME_DIR)
 
     # t-k: change ownership of scan file
     def chown_file(filename):
-        if 'OWNER_UID' in globals():
-            uid = int(OWNER_UID)
-            gid = pwd.getpwuid(uid).pw_gid
-            os.chown(filename, uid, gid)
+        if owner_uid is not None:
+            with timer.stage('chown'):
+                uid = int(owner_uid)
+                gid = pwd.getpwuid(uid).pw_gid
+                os.chown(filename, uid, gid)
 
     # print 'Device options:   ', s.get_options()
     # print 'Device parameters:', s.get_parameters()
@@ -456,17 +1771,32 @@ def scan_and_save(user_selection, imgs=None):
     print("MODE: " + mode)
     dpi = int(user_selection["resolution"].replace('DPI_', ''))
     print("DPI: " + str(dpi))
-    size = SIZE2SANE[user_selection["size"]]
+    # debug mode processes image files without scanner and uses the configured SIZE2SANE
+    size = (scanner.conversions['SIZE2SANE'] if scanner else SIZE2SANE)[user_selection["size"]]
     print("SIZE: " + size)
 
+    # t-k: rotate image if necessary, decided once per job: exact 90 degree transpose
+    #     or, with ORIENTATION 'metadata', an orientation tag for JPEG and TIFF files
+    rotate = bool(re.match('.*rotate', size, re.IGNORECASE))
+    tag_orientation = rotate and ORIENTATION == 'metadata' and \
+        EXTENSIONS[user_selection["format"]] in ('jpg', 'jpeg', 'tif', 'tiff')
+    transpose = Image.Transpose.ROTATE_270 if rotate and not tag_orientation else None
+    # pages read with BandSaneDev are transposed while they are read
+    transposed_in_scan = False
+
     # Initialize scan
 
     def init_scan():
+        nonlocal transposed_in_scan
         print("Scanning ...")
-        s = get_sane_instance()
+        with timer.stage('sane_open'):
+            s = get_sane_instance(scanner)
         s.mode = mode
         s.resolution = dpi
         s.page_format = size  # t-k: bugfix page_format is correct (not page-format)
+        transposed_in_scan = isinstance(s, BandSaneDev)
+        if transposed_in_scan:
+            s.band_transpose = transpose
         imgs = s.multi_scan()
         return imgs, s
 
@@ -475,45 +1805,125 @@ def scan_and_save(user_selection, imgs=None):
 
     # Process images
     output_files = []
-    index = 1
     date = datetime.datetime.now().strftime("%Y-%m-%d")
+
+    save_params = {}
+    if tag_orientation:
+        if EXTENSIONS[user_selection["format"]] in ('jpg', 'jpeg'):
+            exif = Image.Exif()
+            exif[EXIF_ORIENTATION] = ORIENTATION_ROTATE_90_CW
+            save_params['exif'] = exif
+        else:
+            save_params['tiffinfo'] = {EXIF_ORIENTATION: ORIENTATION_ROTATE_90_CW}
+    bilevel, encoder_params = encoder_profile(user_selection)
+    save_params.update(encoder_params)
+
+    # all pages of multi-page PDFs go to the file of the first page
+    multi_page_pdf = user_selection["format"] in ("FORMAT_M_PDF", "FORMAT_PDF")
+    document = None
+
+    def make_base_filename(index):
+        base_filename = Template(user_selection["output"])\
+            .safe_substitute(date=date, uid="%02d" % index,  # t-k: index formatted with padding zero
+                             homedir=home_dir)  # t-k: automatically detect home dir ('~')
+        if OUTPUT_DATE_SUBDIRS:
+            base_filename = os.path.join(os.path.dirname(base_filename), date, os.path.basename(base_filename))
+        return base_filename
+
+    # pages with the time their scan started, the page latency starts there
+    def scanned_pages(imgs):
+        imgs = iter(imgs)
+        while True:
+            start = time.monotonic()
+            try:
+                im = next(imgs)
+            except StopIteration:
+                return
+            timer.add('scan', time.monotonic() - start)
+            # waits in a temporary file for its worker if it doesn't fit into the budget
+            if not budget.take(image_bytes(im)):
+                with timer.stage('spill'):
+                    im = SpilledImage(im, MEMORY_SPILL_DIR)
+                budget.spilled += 1
+                metrics.inc('spilled_pages')
+            yield im, start
+
+    # runs in page order, so file names are deterministic
+    def allocate_filename(page):
+        nonlocal document
+        im, start = page
+        if document:
+            return im, document.filename, start
+        filename = outputIndex.allocate((user_selection["output"], date, home_dir), make_base_filename,
+                                        EXTENSIONS[user_selection["format"]])
+        if OUTPUT_DATE_SUBDIRS and not os.path.isdir(os.path.dirname(filename)):
+            make_output_dirs(filename, home_dir, owner_uid)
+        if multi_page_pdf:
+            document = MultiPagePdf(filename, dpi, PDF_WRITER, encoder_params, budget)
+        return im, filename, start
+
+    # runs in the worker threads of the page pipeline
+    def save_page(job):
+        im, filename, start = job
+        if isinstance(im, SpilledImage):
+            im = im.load()
+            # pages other than 'L' are read back into memory while the worker is busy with them
+            taken = 0 if im.readonly else image_bytes(im)
+            budget.take(taken, always=True)
+        else:
+            taken = image_bytes(im)
+        try:
+            return process_page(im, filename, start)
+        finally:
+            budget.give_back(taken)
+
+    def process_page(im, filename, start):
+        if transpose and not transposed_in_scan:
+            with timer.stage('rotate'):
+                im = im.transpose(transpose)
+        # t-k: print log of applying user filters only if there are any
+        if len(user_selection['filters']):
+            print("Applying user filters to " + filename + " ...")
+            with timer.stage('filters'):
+                im, timings = run_filters(im, user_selection['filters'])  # t-k: replaced img with im
+            print(' ' * 4 + 'Filter timings: ' + ', '.join('%s %.3fs' % timing for timing in timings))
+        if bilevel:
+            with timer.stage('bilevel'):
+                im = to_bilevel(im)
+        if multi_page_pdf:
+            # added to the document in page order by the calling thread
+            return im, start
+        print("Saving " + filename + " ...")
+        im.info['dpi'] = (dpi, dpi)
+        im.info['resolution'] = (dpi, dpi)
+        with timer.stage('encode'):
+            im.save(filename, dpi=(dpi, dpi), resolution=dpi,
+                    **save_params_for(im.mode, save_params, EXTENSIONS[user_selection["format"]]))
+        metrics.inc('written_bytes', os.path.getsize(filename))
+        chown_file(filename)  # t-k: change ownership of scan file
+        print("Done.")
+        return filename, start
+
     while True:
         try:
-            for im in imgs:
-                file_exists = True
-                while file_exists:
-                    base_filename = Template(user_selection["output"])\
-                        .safe_substitute(date=date, uid="%02d" % index,  # t-k: index formatted with padding zero
-                                         homedir=HOME_DIR)  # t-k: automatically detect home dir ('~')
-                    filename = base_filename + '.' + EXTENSIONS[user_selection["format"]]  # t-k: seperate base_filename
-                    file_exists = exists_file_with_other_extension(
-                        base_filename)  # t-k: raise index independent of file extension
-                    index += 1
-                # t-k: rotate image if necessary
-                if re.match('.*rotate', size, re.IGNORECASE):
-                    im = im.rotate(270)
-                # t-k: print log of applying user filters only if there are any
-                if len(user_selection['filters']):
-                    print("Applying user filters to " + filename + " ...")
-                    for userFilter in user_selection['filters']:
-                        im = userFilter(im)  # t-k: replaced img with im
-                print("Saving " + filename + " ...")
-                im.info['dpi'] = (dpi, dpi)
-                im.info['resolution'] = (dpi, dpi)
-                im.save(filename, dpi=(dpi, dpi), resolution=dpi)
-                chown_file(filename)  # t-k: change ownership of scan file
-                print("Done.")
-                output_files.append(filename)
+            for result, start in process_pages(scanned_pages(imgs), allocate_filename, save_page):
+                if multi_page_pdf:
+                    with timer.stage('pdf'):
+                        document.add_page(result)
+                else:
+                    output_files.append(result)
+                metrics.inc('pages')
+                metrics.observe('page_seconds', time.monotonic() - start)
         except Exception as e:
-            if e == 'Error during device I/O':
+            if str(e) == 'Error during device I/O' and scanner:
+                metrics.inc('sane_reconnects')
                 if MODIFIED_SANE:
-                    print('SANE ' + e + '. Restarting proxies and retrying ...', file=sys.stderr)
-                    exit_proxies()
-                    start_proxies()
+                    print('SANE %s. Restarting proxies and retrying ...' % e, file=sys.stderr)
+                    scanner.restart_proxies()
                 else:
-                    print('SANE ' + e + '. Retrying ...', file=sys.stderr)
+                    print('SANE %s. Retrying ...' % e, file=sys.stderr)
                 # s.close() # <- this causes seg fault
-                saneSingleton = None
+                scanner.sane_dev = None
                 imgs, s = init_scan()
             else:
                 print('Whoops! Problem scanning (maybe version Samsung device driver >= 4.1 and multi-scan?):',
@@ -527,35 +1937,25 @@ def scan_and_save(user_selection, imgs=None):
     #     does not yet work, since closing the session raises a seg fault
     #     maybe poor programming of the C based sane extension?
     #     (not incrementing reference count when new references to scanner object are created?)
-    if not SCANNER_CACHING:
+    if not SCANNER_CACHING and scanner:
         # t-k: end session with scanner and reset cache
         # s.close() # <- this causes seg fault
-        saneSingleton = None
+        scanner.sane_dev = None
         # print('Scanner session closed and cache reset.')
         print('Scanner cache reset.')
 
-    # Concat PDFs and delete temp ones
-    if (user_selection["format"] == "FORMAT_M_PDF" or user_selection["format"] == "FORMAT_PDF") and (
-            len(output_files) > 1):
-        print("Concatenating PDF files ...")
-        output = PdfWriter()
-        for aFile in output_files:
-            input_pdf = PdfReader(file(aFile, "rb"))
-            output.addPage(input_pdf.getPage(0))
-        output_stream = io.BytesIO()  # file(output_files[0], "wb")
-        output.write(output_stream)
-        # output_stream.close()
-
-        for aFile in output_files:
-            print("Deleting " + aFile + " ...")
-            os.remove(aFile)
-
-        print("Writing final PDF " + output_files[0] + " ...")
-        output_file = open(output_files[0], "wb")
-        output_file.write(output_stream.getvalue())
-        output_file.close()
-        chown_file(output_files[0])  # t-k: change ownership of scan file
+    if document:
+        with timer.stage('pdf'):
+            document.close()
+        metrics.inc('written_bytes', os.path.getsize(document.filename))
+        chown_file(document.filename)  # t-k: change ownership of scan file
         print("Done.")
+        output_files.append(document.filename)
+
+    print('Job timings: ' + timer.finish())
+    print('Job memory: %s, pages held %.1f MiB at most (budget %s), %d page(s) spilled' % (
+        peak(), budget.peak / (1 << 20), '%d MiB' % MEMORY_BUDGET if MEMORY_BUDGET else 'none', budget.spilled))
+    return output_files
 
 
 def del_pid_file():
@@ -572,13 +1972,12 @@ def del_pid_file():
                   "because it was already deleted (probably by 'sudo service samsungScannerServer stop').")
 
 
-def server_uid_gen():
+def server_uid_gen(servername):
     """
-    generate a UniqueID for this server based on SERVER_NAME and hostname using md5 as hash method
+    generate a UniqueID for the server servername based on its name and hostname using md5 as hash method
     """
     from hashlib import md5
 
-    servername = SERVER_NAME
     hostname = platform.node()
 
     def hash2half_length2int(hash_string):
@@ -657,6 +2056,8 @@ parser.add_option("-d", "--daemon", action='store_true', dest="daemon",
                   help="Fork a daemon")
 parser.add_option("-p", "--pidfile", dest="pidfile",
                   help="File to write the daemon PID")
+parser.add_option("--rediscover", action='store_true', dest="rediscover",
+                  help="Ignore the discovery cache and configure the scanner automatically from scratch")
 
 group = OptionGroup(parser, "Debug Options",
                     "Caution: use these options at your own risk.  "
@@ -667,6 +2068,9 @@ group.add_option("--imageFiles", action="append", dest="imageFiles",
                       "will apply the selected filters, store the result and terminate.")
 group.add_option("--optionsIndex", type="int", dest="optionsIndex", default=0,
                  help="What of the OPTIONS[] to use for processing the --imageFiles.")
+group.add_option("--benchmarkSnmp", type="int", dest="benchmarkSnmp", metavar="COUNT",
+                 help="Send COUNT SNMP queries to the scanner with and without a persistent SNMP session, " +
+                      "print the queries per second and terminate.")
 
 parser.add_option_group(group)
 
@@ -692,23 +2096,59 @@ if not CONFIG_FILE:
     print("Could not find config file (" + CONFIG_FILENAME + ") in " + str(PATHS), file=sys.stderr)
     sys.exit(1)
 
+# Defaults for settings that older configuration files do not contain
+CONFIG_DEFAULTS = {
+    'POLL_INTERVAL_IDLE': 1.0,
+    'POLL_INTERVAL_ACTIVE': 0.25,
+    'POLL_ACTIVE_TIMEOUT': 30,
+    'SERVER_REFRESH_INTERVAL': 300,
+    'SNMP_FAST_PATH': True,
+    'PAGE_QUEUE_DEPTH': 2,
+    'PAGE_WORKERS': 2,
+    'SCAN_BAND_LINES': 256,
+    'MEMORY_BUDGET': None,
+    'MEMORY_SPILL_DIR': None,
+    'FILTER_PROCESSES': 0,
+    'PDF_WRITER': 'append',
+    'OUTPUT_DATE_SUBDIRS': False,
+    'ORIENTATION': 'transpose',
+    'METRICS_PORT': None,
+    'METRICS_ADDRESS': '127.0.0.1',
+    'LOG_BUFFER_SIZE': 10000,
+    'LOG_DROP_ON_OVERFLOW': False,
+    'PAGE_QUERY_TIMEOUT': 300,
+    'PROXY_IN_PROCESS': False,
+    'DISCOVERY_CACHE': '/var/cache/samsungScannerServer.json',
+    'SCANNER_HTTP_PORT': 80,
+    'SCANNER_SNMP_PORT': 161,
+    'ENCODER_PROFILES': {
+        'pillow': {},
+        'lineart': {'bilevel': True, 'compression': 'group4'},
+        'document': {'quality': 60, 'subsampling': '4:2:0', 'optimize': True},
+        'photo': {'quality': 90, 'subsampling': '4:4:4', 'optimize': True, 'progressive': True},
+    },
+    'ENCODER_DEFAULTS': {'COLOR_MONO': 'lineart'},
+}
+for setting, default in CONFIG_DEFAULTS.items():
+    globals().setdefault(setting, default)
+
 
 # ############################## LOGGING ################################
 
 class LogFile(object):
     def __init__(self, name=None):
         self.logger = logging.getLogger(name)
+        # only the last line written, as long as it is not \n terminated
         self.buffer = ""
-        # StringIO.StringIO()
+        # every scanner prints from its own thread
+        self.lock = threading.Lock()
 
     def write(self, msg, level=logging.INFO):
-        self.buffer += msg
-        lines = self.buffer.splitlines()
-        # print>>sys.stderr,lines
-        if self.buffer.count('\n') == len(lines):
-            self.buffer = ""
-        else:
-            # Last line was not \n terminated
+        with self.lock:
+            if '\n' not in msg:
+                self.buffer += msg
+                return
+            lines = (self.buffer + msg).split('\n')
             self.buffer = lines.pop()
         for line in lines:
             self.logger.log(level, line)
@@ -726,71 +2166,99 @@ class FilterEmptyLines(logging.Filter):
 # t-k: classes that handle logging from multiple processes
 #     (supporting rotating log file)
 
-class QueueHandler(logging.Handler):
+class BatchQueueHandler(logging.handlers.QueueHandler):
     """
-    This handler sends events to a queue. Typically, it would be used together
-    with a multiprocessing Queue to centralise logging to file in one process
-    (in a multi-process application), so as to avoid file write contention
-    between processes.
-
-    This code is new in Python 3.2, but this class can be copy pasted into
-    user code for use with earlier Python versions.
+    collects the records of this process and sends them to queue in batches
+    (lists of records) from a background thread, so logging costs the calling
+    thread neither formatting nor pickling nor a write to the pipe.
+    At most buffer_size records wait to be sent, then emit() waits for space or,
+    if drop_on_overflow, drops the record (so a slow log file can never stall
+    scanning); the number of dropped records is logged with the next batch.
     """
-
-    def __init__(self, queue):
-        """
-        Initialise an instance, using the passed queue.
-        """
-        logging.Handler.__init__(self)
-        self.queue = queue
+    BATCH_SIZE = 500
+    BATCH_INTERVAL = 0.1  # seconds a record waits at most for the batch to fill up
+
+    def __init__(self, queue, buffer_size=10000, drop_on_overflow=False):
+        super(BatchQueueHandler, self).__init__(queue)
+        self.buffer_size = buffer_size
+        self.drop_on_overflow = drop_on_overflow
+        self._reset()
+        # the sending thread is not copied into forked processes (e.g. the proxies)
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._records = collections.deque()
+        self._dropped = 0
+        self._sending = False
+        self._closed = False
+        self._sender = None
 
     def enqueue(self, record):
-        """
-        Enqueue a record.
+        with self._cond:
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send_batches, name='log sender', daemon=True)
+                self._sender.start()
+            while len(self._records) >= self.buffer_size:
+                if self.drop_on_overflow or self._closed:
+                    self._dropped += 1
+                    return
+                self._cond.wait()
+            self._records.append(record)
+            if len(self._records) == self.BATCH_SIZE:
+                self._cond.notify_all()
 
-        The base implementation uses put_nowait. You may want to override
-        this method if you want to use blocking, timeouts or custom queue
-        implementations.
-        """
-        self.queue.put_nowait(record)
-
-    def prepare(self, record):
-        """
-        Prepares a record for queuing. The object returned by this method is
-        enqueued.
-
-        The base implementation formats the record to merge the message
-        and arguments, and removes unpickleable items from the record
-        in-place.
+    def emit(self, record):
+        # formatted and prepared for pickling by the sending thread
+        self.enqueue(record)
 
-        You might want to override this method if you want to convert
-        the record to a dict or JSON string, or send a modified copy
-        of the record while leaving the original intact.
+    def _send_batches(self):
+        while True:
+            with self._cond:
+                if len(self._records) < self.BATCH_SIZE and not self._closed:
+                    self._cond.wait(self.BATCH_INTERVAL)
+                if not self._records and not self._dropped:
+                    if self._closed:
+                        return
+                    continue
+                records = [self._records.popleft() for _ in range(min(self.BATCH_SIZE, len(self._records)))]
+                dropped, self._dropped = self._dropped, 0
+                self._sending = True
+                self._cond.notify_all()
+            try:
+                batch = []
+                for record in records:
+                    try:
+                        batch.append(self.prepare(record))
+                    except Exception:
+                        self.handleError(record)
+                if dropped:
+                    batch.append(logging.makeLogRecord({
+                        'name': 'log', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                        'msg': 'Dropped %d log records, logging could not keep up.' % dropped}))
+                self.queue.put(batch)
+            finally:
+                with self._cond:
+                    self._sending = False
+                    self._cond.notify_all()
+
+    def flush(self, timeout=5.0):
         """
-        # The format operation gets traceback text into record.exc_text
-        # (if there's exception data), and also puts the message into
-        # record.message. We can then use this to replace the original
-        # msg + args, as these might be unpickleable. We also zap the
-        # exc_info attribute, as it's no longer needed and, if not None,
-        # will typically not be pickleable.
-        self.format(record)
-        record.msg = record.message
-        record.args = None
-        record.exc_info = None
-        return record
-
-    def emit(self, record):
+        wait (at most timeout seconds) until all records were sent
         """
-        Emit a record.
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self._sender is None:
+                return
+            self._cond.notify_all()
+            while (self._records or self._sending) and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
 
-        Writes the LogRecord to the queue, preparing it for pickling first.
-        """
-        try:
-            self.enqueue(self.prepare(record))
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            self.handleError(record)
+    def close(self):
+        with self._cond:
+            self._closed = True
+        self.flush()
+        super(BatchQueueHandler, self).close()
 
 
 def listener_configurer():
@@ -815,11 +2283,12 @@ def listener_process(queue, configurer):
     configurer()
     while True:
         try:
-            record = queue.get()
-            if record is None:  # We send this as a sentinel to tell the listener to quit.
+            records = queue.get()  # batch of records sent by BatchQueueHandler
+            if records is None:  # We send this as a sentinel to tell the listener to quit.
                 break
-            logger = logging.getLogger(record.name)
-            logger.handle(record)  # No level or filter logic applied - just do it!
+            for record in records:
+                logger = logging.getLogger(record.name)
+                logger.handle(record)  # No level or filter logic applied - just do it!
         except (KeyboardInterrupt, SystemExit):
             # raise
             pass  # handled by signal and atexit
@@ -831,10 +2300,20 @@ def listener_process(queue, configurer):
 
 
 def worker_configurer(queue):
-    h = QueueHandler(queue)  # Just the one handler needed
+    h = BatchQueueHandler(queue, LOG_BUFFER_SIZE, LOG_DROP_ON_OVERFLOW)  # Just the one handler needed
     root = logging.getLogger()
     root.addHandler(h)
     root.setLevel(logging.INFO)
+    return h
+
+
+def filter_process_configurer(queue):
+    """
+    log from a filter process like from the daemon
+    """
+    worker_configurer(queue)
+    sys.stdout = LogFile('stdout')
+    sys.stderr = LogFile('stderr')
 
 
 if __name__ == '__main__':
@@ -851,19 +2330,25 @@ if __name__ == '__main__':
             sys.exit(1)
 
     # t-k: Logging supporting multiprocessing
-    logQ = multiprocessing.Queue()
-    listener = multiprocessing.Process(target=listener_process,
+    #     bounded, so a listener that can not keep up lets the records pile up in the log handler
+    logQ = multiprocessing.Queue(64)
+    listener = multiprocessing.Process(target=listener_process, name='log listener',
                                        args=(logQ, listener_configurer))
     listener.start()
 
-    worker_configurer(logQ)
+    # still no other threads running (the log handler starts one)
+    if FILTER_PROCESSES:
+        start_filter_pool(filter_process_configurer, (logQ,))
+
+    logHandler = worker_configurer(logQ)
 
     sys.stdout = LogFile('stdout')
     sys.stderr = LogFile('stderr')
 
 
     def exit_listener():
-        logQ.put_nowait(None)
+        logHandler.close()
+        logQ.put(None)
 
 
     # Print version
@@ -896,6 +2381,7 @@ if __name__ == '__main__':
     if options.imageFiles:
         print("Running in debug mode!")
         HOME_DIR = "/tmp/"
+        from PIL import Image
         imgs = []
         for imageFile in options.imageFiles:
             imgs.append(Image.open(imageFile))
@@ -944,16 +2430,31 @@ def extractIPs(file_content):
     return ips
 
 
+discovery_cache = DiscoveryCache(DISCOVERY_CACHE, ignore_saved=options.rediscover)
+
 # t-k: Get scanner name automatically, try again if nothing found (e.g. no network connection)
-if 'SCANNER_SANE_NAME' not in globals():
-    while True:
+if 'SCANNERS' not in globals() and 'SCANNER_SANE_NAME' not in globals():
+    # a scanner found before is taken as long as it answers with the same capabilities
+    discovered = discovery_cache.get('SCANNER_SANE_NAME')
+    if discovered and discovery_cache.valid(discovered, discovered['ip'], SCANNER_HTTP_PORT, timeout=2.0):
+        SCANNER_SANE_NAME = discovered['sane_name']
+        print_autoconfig(SCANNER_SANE_NAME, 'SCANNER_SANE_NAME (cached)')
+    while 'SCANNER_SANE_NAME' not in globals():
         print("Init SANE ...")
-        sane.init()  # t-k: bugfix, can't find any devs without init
+        import_sane().init()  # t-k: bugfix, can't find any devs without init
         devs = sane.get_devices()
         for dev in devs:
             if dev[1].upper() == 'SAMSUNG':
                 SCANNER_SANE_NAME = dev[0]
                 print_autoconfig(SCANNER_SANE_NAME, 'SCANNER_SANE_NAME')
+                try:
+                    discovered = {'sane_name': SCANNER_SANE_NAME, 'ip': extractIPs(SCANNER_SANE_NAME)[0]}
+                    discovered['cap_sha256'], discovered['cap_etag'], _ = fetch_cap_xml(
+                        discovered['ip'], SCANNER_HTTP_PORT, timeout=2.0)
+                except Exception as e:
+                    print('Not caching the scanner found: %s' % e, file=sys.stderr)
+                else:
+                    discovery_cache.set('SCANNER_SANE_NAME', discovered)
                 break
         if 'SCANNER_SANE_NAME' not in globals():
             if devs:
@@ -962,8 +2463,6 @@ if 'SCANNER_SANE_NAME' not in globals():
                 tmpinsert = ''
             sys.stderr.write('No%s Scanner found. Trying again in 30s.\n' % tmpinsert)
             time.sleep(30)
-        else:
-            break
 
 if 'SERVER_NAME' not in globals():
     SERVER_NAME = platform.node()  # t-k: = hostname
@@ -985,27 +2484,19 @@ else:
         OWNER = pwd.getpwuid(OWNER_UID).pw_name
         print_autoconfig(OWNER, 'OWNER')
 
-# t-k: always automatically retrieve home dir and extract IP
+# t-k: always automatically retrieve home dir
 HOME_DIR = pwd.getpwuid(OWNER_UID).pw_dir
 print_autoconfig(HOME_DIR, 'HOME_DIR')
-# t-k: updated IP extraction method (thanks to frankentux)
-try:
-    SCANNER_IP = extractIPs(SCANNER_SANE_NAME)[0]
-except IndexError:  # regex failed?
-    print("Couldn't recognize IPv4 of scanner '%s'." % SCANNER_SANE_NAME, file=sys.stderr)
-    sys.exit(1)
-print_autoconfig(SCANNER_IP, 'SCANNER_IP')
-REAL_SCANNER_IP = SCANNER_IP  # t-k: preserve IP if changed by MODIFIED_SANE method
 
-# t-k: get own server IP and change scanner name to include that
+
+# t-k: get own server IP to change scanner name to include that
 #     (so later sane connects to scanner via proxy not directly)
-if MODIFIED_SANE:
-    print('Getting server IP and setting scanner name so that SANE uses proxy.')
+def get_server_ip(scanner_ip, port=80):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.settimeout(2.0)
     while True:
         try:
-            sock.connect((SCANNER_IP, 80))
+            sock.connect((scanner_ip, port))
         except socket.error as e:
             if e.errno == errno.EALREADY:  # operation already in progress
                 time.sleep(1)
@@ -1020,30 +2511,98 @@ if MODIFIED_SANE:
             break
     # only way to get server IP without knowing network device name
     #     which IP connects to scanner? (/etc/hosts not working because: hostname 127.0.0.1)
-    SERVER_IP = sock.getsockname()[0]
+    server_ip = sock.getsockname()[0]
     sock.close()
-    del sock
-    print_autoconfig(SERVER_IP, 'SERVER_IP')
-    SCANNER_SANE_NAME = ' '.join(SCANNER_SANE_NAME.split(' ')[:-1] + [SERVER_IP])
-    print_autoconfig(SCANNER_SANE_NAME, 'SCANNER_SANE_NAME')
+    return server_ip
+
+
+# Scanners served by this daemon: either the ones configured in SCANNERS or a single one
+#     made of SCANNER_SANE_NAME. Every scanner offers the servers configured in its 'servers'
+#     (default SERVERS) or a single one made of SERVER_NAME, OPTIONS and the owner configured above
+if 'SERVERS' not in globals():
+    SERVERS = [{'name': SERVER_NAME, 'options': OPTIONS}]
+if 'SCANNERS' not in globals():
+    SCANNERS = [{'sane_name': SCANNER_SANE_NAME}]
+SCANNER_SESSIONS = []
+for scanner_config in SCANNERS:
+    try:
+        scanner = ScannerSession(scanner_config['sane_name'],
+                                 {'SIZE2SANE': scanner_config.get('size2sane', globals().get('SIZE2SANE'))},
+                                 scanner_config.get('http_port', SCANNER_HTTP_PORT),
+                                 scanner_config.get('snmp_port', SCANNER_SNMP_PORT))
+    except IndexError:  # regex failed?
+        print("Couldn't recognize IPv4 of scanner '%s'." % scanner_config['sane_name'], file=sys.stderr)
+        sys.exit(1)
+    if scanner.conversions['SIZE2SANE'] is None:
+        del scanner.conversions['SIZE2SANE']
+    print_autoconfig(scanner.ip, 'SCANNER_IP')
+    # with MODIFIED_SANE found out below unless configured
+    scanner.proxy_ip = scanner_config.get('proxy_ip')
+
+    for server in scanner_config.get('servers', SERVERS):
+        if 'owner_uid' in server:
+            server_owner_uid = int(server['owner_uid'])
+        elif 'owner' in server:
+            server_owner_uid = pwd.getpwnam(server['owner']).pw_uid
+        else:
+            server_owner_uid = OWNER_UID
+        server_options = server.get('options', OPTIONS)
+        if 'output' in server:
+            server_options = [dict(option, output=server['output']) for option in server_options]
+        scanner.add_registration(server['name'], server_options, server_owner_uid)
+    print_autoconfig(scanner.registrations, 'REGISTRATIONS', no_quotes=True)
+    SCANNER_SESSIONS.append(scanner)
+
 
 # t-k: check to see if scanning directory exists to create it if neccessary
 # angelnu: support scanning outside home
-dirsToMake = Template(OUTPUT_PREFIX).safe_substitute(homedir=HOME_DIR).split('/')[1:-1]
-for i in range(1, len(dirsToMake)):
-    dirToMake = "/" + "/".join(dirsToMake[0:i + 1])
-    if os.path.lexists(dirToMake):
-        if not os.path.isdir(dirToMake):
-            raise OSError('Invalid OUTPUT_PREFIX given in configuration file.\n' +
-                          ' ' * 9 + 'The path specified exists, but is not a directory!\n' +
-                          ' ' * 9 + "You should either change OUTPUT_PREFIX or check '%s' and move or rename it."
-                          % dirToMake)
-    else:
-        os.mkdir(dirToMake)
-        uid = int(OWNER_UID)
-        gid = pwd.getpwuid(uid).pw_gid
-        os.chown(dirToMake, uid, gid)
-        print("Created the directory '%s'." % dirToMake)
+def make_output_dirs(output_prefix, home_dir, owner_uid):
+    dirsToMake = Template(output_prefix).safe_substitute(homedir=home_dir).split('/')[1:-1]
+    for i in range(1, len(dirsToMake)):
+        dirToMake = "/" + "/".join(dirsToMake[0:i + 1])
+        if os.path.lexists(dirToMake):
+            if not os.path.isdir(dirToMake):
+                raise OSError('Invalid output prefix given in configuration file.\n' +
+                              ' ' * 9 + 'The path specified exists, but is not a directory!\n' +
+                              ' ' * 9 + "You should either change the output prefix or check '%s' and move or "
+                              "rename it." % dirToMake)
+        else:
+            os.mkdir(dirToMake)
+            uid = int(owner_uid)
+            gid = pwd.getpwuid(uid).pw_gid
+            os.chown(dirToMake, uid, gid)
+            print("Created the directory '%s'." % dirToMake)
+
+
+def prepare_output_dirs(scanners):
+    for output_prefix, home_dir, owner_uid in {(option['output'], registration.home_dir, registration.owner_uid)
+                                               for scanner in scanners
+                                               for registration in scanner.registrations
+                                               for option in registration.options}:
+        make_output_dirs(output_prefix, home_dir, owner_uid)
+        if not OUTPUT_DATE_SUBDIRS:
+            outputIndex.scan(os.path.dirname(Template(output_prefix).safe_substitute(homedir=home_dir)))
+
+
+# the output directories are prepared while the scanners are contacted for the IPs of the proxies
+startup = StartupTasks()
+startup.add('output directories', prepare_output_dirs, SCANNER_SESSIONS)
+if MODIFIED_SANE:
+    print('Getting server IP and setting scanner name so that SANE uses proxy.')
+    for scanner in SCANNER_SESSIONS:
+        if not scanner.proxy_ip:
+            startup.add('server IP for %s' % scanner.ip, get_server_ip, scanner.ip, scanner.http_port)
+    for i, scanner in enumerate(SCANNER_SESSIONS):
+        if not scanner.proxy_ip:
+            scanner.proxy_ip = startup.result('server IP for %s' % scanner.ip)
+        print_autoconfig(scanner.proxy_ip, 'SERVER_IP')
+        if scanner.proxy_ip in [other.proxy_ip for other in SCANNER_SESSIONS[:i]]:
+            print("Proxies of scanner '%s' would listen on the same IP as another scanner's, configure a "
+                  "different 'proxy_ip' for it." % scanner.sane_name, file=sys.stderr)
+            sys.exit(1)
+        scanner.sane_name = ' '.join(scanner.sane_name.split(' ')[:-1] + [scanner.proxy_ip])
+        print_autoconfig(scanner.sane_name, 'SCANNER_SANE_NAME')
+startup.result('output directories')
 
 if __name__ == '__main__':
 
@@ -1052,148 +2611,270 @@ if __name__ == '__main__':
         print("Server not enabled")
         sys.exit(0)
 
+    # Debug mode
+    if options.benchmarkSnmp:
+        benchmark_snmp(SCANNER_SESSIONS[0], options.benchmarkSnmp)
+        sys.exit(0)
+
 
 # ############################### CLASSES ################################
 
-# t-k: class that handles hex messages
-class HexMessage(object):
+# t-k: hex messages of the scanner protocol
+def hex_message(hex_in, enlarge_to=0):
     """
-    instances can store, return and prettyprint hex messages
+    return the bytes of a hex message in the form '1b:a8:13:fb' or '1b a8 13 fb',
+    set enlarge_to > 0 to pad with zero bytes, e.g. enlarge_to=255 to end up with
+    a message length of at least 255 bytes
     """
+    return bytes.fromhex(hex_in.replace(':', ' ')).ljust(enlarge_to, b'\x00')
 
-    def __init__(self, hex_in, raw_in=False, enlarge_to: int = False):
-        """
-        hex_in should be either in the form '1b:a8:13:fb' or
-        '1b a8 13 fb' (raw_in=False, default) or as decoded python
-        character string '\x1b\xa8\x13\xfb' (raw_in=True)
 
-        default message size is length of hex_in, set enlarge_to > 0
-        to enable enlarging with zero bytes, e.g. enlarge_to=255 to
-        end up with message length of at least 255 bytes
-        """
-        if raw_in:
-            msg = hex_in
-        else:
-            msg = hex_in.replace(':', '').replace(' ', '').replace('\n', '')
-            msg = msg.decode('hex_codec')
-        if enlarge_to:
-            bytes_left = enlarge_to - len(msg)
-            self.msg = (msg + '\x00' * bytes_left)
-        else:
-            self.msg = msg
+class HexDump(object):
+    """
+    prettyprinted hex dump of a message for the log, only formatted if it is
+    actually logged (max_lines=None: whole message). Log records may be formatted
+    after the receive buffers were reused, so msg must not be a view of one of them
+    """
+    __slots__ = ('msg', 'max_lines')
 
-    def get_msg(self):
-        """
-        return hex message as decoded character string
-        """
-        return self.msg
+    def __init__(self, msg, max_lines=None):
+        self.msg = msg
+        self.max_lines = max_lines
 
-    def startswith(self, prefix, start=0, end=sys.maxsize):
-        """
-        analogous to str.startswith, takes HexMessage instance as prefix
-        might also be a tuple of HexMessage instances
-        """
-        if isinstance(prefix, tuple):
-            msg_lst = []
-            for p in prefix:
-                msg_lst.append(p.get_msg())
-            prefix = tuple(msg_lst)
-        else:
-            prefix = prefix.get_msg()
-        return self.msg.startswith(prefix, start, end)
+    def __str__(self):
+        msg = self.msg if self.max_lines is None else self.msg[:20 * self.max_lines]
+        lines = []
+        for line_start in range(0, len(msg), 20):
+            hex_bytes = ['%02x' % byte for byte in msg[line_start:line_start + 20]]
+            # groups of 5 bytes
+            lines.append('  '.join(' '.join(hex_bytes[i:i + 5]) for i in range(0, len(hex_bytes), 5)))
+        return '\n'.join(lines)
 
-    def __eq__(self, other):
-        return self.msg == other.get_msg()
 
-    def __hash__(self):
-        return hash(self.msg)
+class ProxyControl(object):
+    """
+    one end of the control channel between SANE and the TCP proxy, a socketpair
+    carrying messages of 2 bytes: opcode and sequence number of the request,
+    answers carry the sequence number of their request so late answers to
+    cancelled requests can be told apart
+    """
+    CHECK_PAGE = 1  # request: is another page coming?
+    CANCEL = 2  # request: forget the request with this sequence number
+    NEW_PAGE = 3  # answer: yes new page
+    NO_MORE_PAGES = 4  # answer: no more pages
+    POLL_INTERVAL = 1.0  # seconds between checks whether the other end is still alive
 
-    def __str__(self):
-        msg_encoded = self.msg.encode('hex_codec')
-        res = ''
-        for i in range(2, len(msg_encoded) + 1, 2):
-            res += msg_encoded[i - 2:i] + ' '
-            if (i % 10) == 0:
-                res += ' '
-            if (i % 40) == 0:
-                res += '\n'
-        return res.rstrip(' \n')
+    def __init__(self, sock):
+        self.sock = sock
+        self._seq = 0
 
+    @classmethod
+    def pair(cls):
+        first, second = socket.socketpair()
+        return cls(first), cls(second)
 
-# t-k: proxy subprocess classes
+    def fileno(self):
+        return self.sock.fileno()
 
-class ProxyError(Exception):
-    """
-    exception to raise for handling proxy specific errors
-    """
-    pass
+    def close(self):
+        self.sock.close()
+
+    def send(self, opcode, seq=0):
+        self.sock.sendall(bytes((opcode, seq)))
+
+    def recv(self, timeout=None):
+        """
+        return (opcode, sequence number) of the next message,
+        raises socket.timeout after timeout seconds, EOFError if the other end is closed
+        """
+        self.sock.settimeout(timeout)
+        msg = self.sock.recv(2, socket.MSG_WAITALL)
+        if len(msg) < 2:
+            raise EOFError('control channel closed')
+        return msg[0], msg[1]
+
+    def request(self, opcode, timeout=None, alive=None):
+        """
+        send the request opcode and return the opcode of its answer, the request is
+        cancelled if there is no answer within timeout seconds (TimeoutError) or
+        alive() tells the other end is gone (EOFError)
+        """
+        self._seq = (self._seq + 1) & 0xff
+        self.send(opcode, self._seq)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    self.send(self.CANCEL, self._seq)
+                    raise TimeoutError('no answer within %s seconds' % timeout)
+            try:
+                answer, seq = self.recv(wait)
+            except socket.timeout:
+                if alive is not None and not alive():
+                    raise EOFError('other end of the control channel is gone')
+                continue
+            if seq == self._seq:
+                return answer
 
 
-class ProxyProcess(multiprocessing.Process):
+# t-k: proxy subprocess classes
+
+class ProxyProcess(object):
     """
-    a subprocess that acts as a man in the middle (MITM) proxy between
-    scanner and workstation, so it can interfere with the messages
-    being sent back and forth
+    a subprocess (or with PROXY_IN_PROCESS a thread of the daemon) that acts
+    as a man in the middle (MITM) proxy between scanner and workstation,
+    so it can interfere with the messages being sent back and forth
     """
     BUFFERSIZE = 1240
-    SERVER_IP = ''
-    SCANNER_IP = SCANNER_IP
     DEBUGLEVEL = PROXY_DEBUGLEVEL  # 0 -> no | 1 -> a bit | 2 -> a bit more | 3 -> lots of printing
 
-    def __init__(self):
-        super(ProxyProcess, self).__init__()
-        self._stoprequest = multiprocessing.Event()
+    def __init__(self, scanner_ip, server_ip=''):
+        self.SCANNER_IP = scanner_ip
+        self.SERVER_IP = server_ip
+        if PROXY_IN_PROCESS:
+            self._stoprequest = threading.Event()
+            self._worker = threading.Thread(target=self.serve, name=self.__class__.__name__, daemon=True)
+        else:
+            self._stoprequest = multiprocessing.Event()
+            self._worker = multiprocessing.Process(target=self.run, name=self.__class__.__name__)
+        # the serve loops wait for this socket too, so join does not have to wait for their timeout
+        self._wakeup, self._waker = socket.socketpair()
+
+    def start(self):
+        self._worker.start()
+
+    def is_alive(self):
+        return self._worker.is_alive()
 
     def join(self, timeout=None):
         self._stoprequest.set()
-        super(ProxyProcess, self).join(timeout)
+        try:
+            self._waker.send(b'\0')
+        except OSError:
+            pass
+        self._worker.join(timeout)
+        if not self._worker.is_alive():
+            self._wakeup.close()
+            self._waker.close()
+
+    def run(self):
+        try:
+            self.serve()
+        finally:
+            # records still waiting in the log handler would be lost when the process exits
+            logging.shutdown()
+
+    def _drain_wakeup(self):
+        self._wakeup.recv(16)
 
-    def _printLog(self, debug_level, *content):
+    def _log(self, debug_level, msg, *args):
         """
-        debug_level -> of this log entry
+        debug_level -> of this log entry, msg is only formatted with args if it is logged
         """
         if self.DEBUGLEVEL >= debug_level:
-            print(str(self.__class__).split('.')[1][:-2] + ':', end=' ')
-            for element in content[:-1]:
-                print(element, end=' ')
-            print(content[-1])
+            logging.getLogger(self.__class__.__name__).info(msg, *args)
 
 
 class UDProxy(ProxyProcess):
     """
-    MITM UDP proxy on port 161 (SNMP)
+    MITM UDP proxy on port 161 (SNMP),
+    relays the datagrams of every requester through its own socket to the
+    scanner so several requests can be in flight at once
     """
     PORT = 161
     PROTOCOL = 'UDP'
+    DATAGRAMSIZE = 65535
+    REQUEST_TIMEOUT = 5.0  # seconds until an unanswered request is given up
+    RELAY_TIMEOUT = 60.0  # seconds until the socket of an idle requester is closed
 
-    def __init__(self):
-        super(UDProxy, self).__init__()
+    def __init__(self, scanner_ip, server_ip=''):
+        super(UDProxy, self).__init__(scanner_ip, server_ip)
         self.serverConn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.serverConn.bind((self.SERVER_IP, self.PORT))
-        self.serverConn.settimeout(1.0)
-        self.clientConn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    def run(self):
-        self._printLog(1, 'Initated server listening on port %d (%s) ...' % (self.PORT, self.PROTOCOL))
-        self._printLog(1, 'Initiated client connection to scanner port %d (%s) ...' % (self.PORT, self.PROTOCOL))
-        while not self._stoprequest.is_set():
-            try:
-                from_ws, addr_ws = self.serverConn.recvfrom(self.BUFFERSIZE)
-                self._printLog(3, 'received %4d bytes from %s:%5d' % (len(from_ws), addr_ws[0], addr_ws[1]))
-            except socket.timeout:
-                continue
-            self.serverConn.settimeout(None)
-            sent_size_client = self.clientConn.sendto(from_ws, (self.SCANNER_IP, self.PORT))
-            self._printLog(3, 'sent     %4d bytes to   %s:%5d' % (sent_size_client, self.SCANNER_IP, self.PORT))
-            from_scanner, addr_sc = self.clientConn.recvfrom(self.BUFFERSIZE)
-            self._printLog(3, 'received %4d bytes from %s:%5d' % (len(from_scanner), addr_sc[0], addr_sc[1]))
-            sent_size_server = self.serverConn.sendto(from_scanner, (addr_ws[0], addr_ws[1]))
-            self._printLog(3, 'sent     %4d bytes to   %s:%5d' % (sent_size_server, addr_ws[0], addr_ws[1]))
-            self.serverConn.settimeout(1.0)
-        # execute when process is joined (closed)
-        self.serverConn.close()
-        self.clientConn.close()
-        self._printLog(1, 'closed!')
+        self.serverConn.setblocking(False)
+        self._buffer = bytearray(self.DATAGRAMSIZE)
+        self._view = memoryview(self._buffer)
+        # address of requester -> [socket to scanner, {request id -> deadline}, time of last request]
+        self._relays = {}
+
+    def _from_requester(self):
+        size, addr_ws = self.serverConn.recvfrom_into(self._buffer)
+        self._log(3, 'received %4d bytes from %s:%5d', size, addr_ws[0], addr_ws[1])
+        now = time.monotonic()
+        relay = self._relays.get(addr_ws)
+        if relay is None:
+            conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            conn.setblocking(False)
+            conn.connect((self.SCANNER_IP, self.PORT))
+            relay = self._relays[addr_ws] = [conn, {}, now]
+            self._selector.register(conn, selectors.EVENT_READ, addr_ws)
+            self._log(2, 'new requester %s:%d', addr_ws[0], addr_ws[1])
+        relay[2] = now
+        request_id = snmp_request_id(self._view[:size])
+        if request_id is not None:
+            relay[1][request_id] = now + self.REQUEST_TIMEOUT
+        sent_size_client = relay[0].send(self._view[:size])
+        self._log(3, 'sent     %4d bytes to   %s:%5d (request %s)', sent_size_client, self.SCANNER_IP, self.PORT,
+                  request_id)
+
+    def _from_scanner(self, conn, addr_ws):
+        size = conn.recv_into(self._buffer)
+        request_id = snmp_request_id(self._view[:size])
+        self._log(3, 'received %4d bytes from %s:%5d (request %s)', size, self.SCANNER_IP, self.PORT, request_id)
+        pending = self._relays[addr_ws][1]
+        if request_id is not None:
+            if pending.pop(request_id, None) is None:
+                self._log(2, 'dropped reply to expired or unknown request %d of %s:%d', request_id, *addr_ws)
+                return
+        sent_size_server = self.serverConn.sendto(self._view[:size], addr_ws)
+        self._log(3, 'sent     %4d bytes to   %s:%5d', sent_size_server, addr_ws[0], addr_ws[1])
+
+    def _expire(self, now):
+        for addr_ws, (conn, pending, last_request) in list(self._relays.items()):
+            for request_id, deadline in list(pending.items()):
+                if deadline < now:
+                    del pending[request_id]
+                    self._log(2, 'no reply to request %d of %s:%d', request_id, *addr_ws)
+            if now - last_request > self.RELAY_TIMEOUT:
+                self._selector.unregister(conn)
+                conn.close()
+                del self._relays[addr_ws]
+                self._log(2, 'requester %s:%d idle, closed its relay', *addr_ws)
+
+    def serve(self):
+        self._log(1, 'Initated server listening on port %d (%s) ...', self.PORT, self.PROTOCOL)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.serverConn, selectors.EVENT_READ)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        next_expiry = time.monotonic() + 1.0
+        try:
+            while not self._stoprequest.is_set():
+                for key, _ in self._selector.select(1.0):
+                    try:
+                        if key.fileobj is self.serverConn:
+                            self._from_requester()
+                        elif key.fileobj is self._wakeup:
+                            self._drain_wakeup()
+                        else:
+                            self._from_scanner(key.fileobj, key.data)
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    except OSError as e:
+                        # e.g. ICMP port unreachable of the scanner, the requester will retry
+                        self._log(1, 'relaying datagram failed: %s', e)
+                now = time.monotonic()
+                if now >= next_expiry:
+                    self._expire(now)
+                    next_expiry = now + 1.0
+        finally:
+            # execute when process is joined (closed)
+            for conn, pending, last_request in self._relays.values():
+                conn.close()
+            self._selector.close()
+            self.serverConn.close()
+            self._log(1, 'closed!')
 
 
 class TCProxy(ProxyProcess):
@@ -1204,216 +2885,273 @@ class TCProxy(ProxyProcess):
     PROTOCOL = 'TCP'
     SRCPORT = 0  # 2270 # for client connection with scanner, set to 0 if dynamic source port wanted
 
-    def __init__(self, query_q, result_q):
-        super(TCProxy, self).__init__()
-        self.queryQ = query_q
-        self.resultQ = result_q
+    # messages of the scanner protocol
+    NEXT_PAGE_REQUEST = hex_message('1b a8 20 fb 01 2c 01', enlarge_to=255)  # needed after INIT_MSG2
+    PLEASE_WAIT = hex_message('a8 08 00 00 00 f9 00 00 01 00 1e', enlarge_to=255)
+    YES_NEW_PAGE = hex_message('a8 00 00 00 00 f9 00 00 01 00 1e', enlarge_to=255)
+    NO_MORE_PAGES = hex_message('a8 04 00 00 00 f9 00 00 01 00 1e', enlarge_to=255)
+    CANCELING = hex_message('a8 04 f9 00 00 00 00 01', enlarge_to=255)
+    ERROR_3BYTE_MSG = hex_message('a8 28 00')
+    INIT_MSG1 = hex_message('1b a8 12 00')  # first sent by sane
+    INIT_MSG2 = hex_message('1b a8 16 00')  # second sent by sane
+    SPEC_MSG = hex_message('1b a8 13 fb', enlarge_to=255)  # not sent by sane, but needed after INIT_MSG1
+
+    PAGE_CHECK_TIMEOUT = 1.0  # seconds to wait for the answer to NEXT_PAGE_REQUEST before asking again
+    PLEASE_WAIT_DELAY = 0.5  # seconds to wait before asking again after PLEASE_WAIT
+    ANSWER_IDLE = 0.25  # seconds without a packet ending an answer of the scanner
+    ANSWER_IDLE_AFTER_FULL = 1.0  # the same after a full packet (BUFFERSIZE bytes)
+
+    def __init__(self, scanner_ip, server_ip, control):
+        super(TCProxy, self).__init__(scanner_ip, server_ip)
+        # SANE asks through this connection whether another page is coming
+        self.control = control
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # connections of the last proxy in TIME_WAIT would block the port for a while
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind((self.SERVER_IP, self.PORT))
         self.server.listen(1)
-        self.server.settimeout(1.0)
-        self.clientConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.clientConn = None
         self.server_conn = self.server_conn_addr = None
-        if self.SRCPORT:
-            self.clientConn.bind((self.SERVER_IP, self.SRCPORT))
-        self.npRequest = HexMessage('1b a8 20 fb 01 2c 01', enlarge_to=255)  # np = next page
-
-    def _check_next_page_status(self):
-        please_wait = HexMessage('a8 08 00 00 00 f9 00 00 01 00 1e', enlarge_to=255)
-        yes_new_page = HexMessage('a8 00 00 00 00 f9 00 00 01 00 1e', enlarge_to=255)
-        no_more_pages = HexMessage('a8 04 00 00 00 f9 00 00 01 00 1e', enlarge_to=255)
-        canceling = HexMessage('a8 04 f9 00 00 00 00 01', enlarge_to=255)
-        result = None
-        self.clientConn.settimeout(1.0)
-        while not self._stoprequest.is_set():
-            try:
-                sent_size_client = self.clientConn.send(self.npRequest.get_msg())
-                self._printLog(3, 'checking if there are more pages to come ...')
-                self._printLog(3, 'sent     %4d bytes to   scanner' % sent_size_client)
-                self._printLog(3, str(self.npRequest).split('\n')[0])
-                from_scanner = self.clientConn.recv(self.BUFFERSIZE)
-                fr_sc_hx_msg = HexMessage(from_scanner, raw_in=True)
-                self._printLog(3, 'received %4d bytes from scanner' % (len(from_scanner)))
-                self._printLog(3, str(fr_sc_hx_msg).split('\n')[0])
-            except socket.timeout:
-                continue
-            if fr_sc_hx_msg == please_wait:
-                self._printLog(3, '"please wait"')
-                time.sleep(0.5)
-                continue
-            elif fr_sc_hx_msg == yes_new_page:
-                result = 'yes new page'
-                self._printLog(1, '"%s"' % result)
-                break
-            elif fr_sc_hx_msg in [no_more_pages, canceling]:
-                result = 'no more pages'
-                self._printLog(1, '"%s"' % result)
-                break
-            else:
-                self._printLog(1, 'could not interpret answer from scanner,\n' + str(fr_sc_hx_msg) + '\nretrying ...')
-                continue
-        self.clientConn.settimeout(None)
-        return result
+        self.nr_connect = 0
+        # packets are received into these buffers and relayed from views of them without copying
+        self._ws_buffer = bytearray(self.BUFFERSIZE)
+        self._ws_view = memoryview(self._ws_buffer)
+        self._scanner_buffer = bytearray(self.BUFFERSIZE)
+        self._scanner_view = memoryview(self._scanner_buffer)
+        # message to send to the scanner after its answer to INIT_MSG1/2 was relayed,
+        #     the workstation has to wait until then
+        self._inject = None
+        # handler of the next packet of the scanner instead of relaying it to the workstation
+        self._intercept = None
+        # (time, function) to call if nothing else happened until then
+        self._timer = None
+        # sequence number of the page check of SANE being answered, NEXT_PAGE_REQUEST sent but not answered
+        self._page_check = None
+        self._page_asked = False
+        self._selector = None
+        self._selector_state = None
+
+    def _connect_scanner(self):
+        if self.clientConn is None:
+            self.clientConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.SRCPORT:
+                self.clientConn.bind((self.SERVER_IP, self.SRCPORT))
+            self.clientConn.connect((self.SCANNER_IP, self.PORT))
+            self._log(1, 'Initiated client connection to scanner port %d (%s) ...', self.PORT, self.PROTOCOL)
+
+    def _close_scanner(self):
+        if self.clientConn is not None:
+            self.clientConn.close()
+            self.clientConn = None
+
+    def _close_workstation(self):
+        if self.server_conn is not None:
+            self.server_conn.close()
+            self.server_conn = None
 
-    def run(self):
-        result = None
-        nr_connect = 1
-        error3byte_msg = HexMessage('a8 28 00')
-        init_msg1 = HexMessage('1b a8 12 00')  # first sent by sane
-        init_msg2 = HexMessage('1b a8 16 00')  # second sent by sane
-        spec_msg = HexMessage('1b a8 13 fb', enlarge_to=255)  # not sent by sane, but needed after init_msg1
-        # self.npRequest needed after init_msg2
-        self._printLog(1, 'Initating server listening on port %d (%s) ...' % (self.PORT, self.PROTOCOL))
-        # main loop starting with connection initiation with workstation (proxy as server)
+    def _state(self):
+        return self.server_conn, self.clientConn, self._intercept is None, self._inject is None
+
+    def _update_selector(self):
+        """
+        wait for the workstation only when the scanner is not busy with messages of the proxy
+        (so they can not get mixed up), for the scanner only if someone takes its packets
+        """
+        state = self._state()
+        if state == self._selector_state:
+            return
+        self._selector_state = state
+        wanted = {self.control: self._from_control, self._wakeup: self._drain_wakeup}
+        if self.server_conn is None:
+            wanted[self.server] = self._accept
+        elif self._intercept is None and self._inject is None:
+            wanted[self.server_conn] = self._from_workstation
+        if self.clientConn is not None and (self.server_conn is not None or self._intercept is not None):
+            wanted[self.clientConn] = self._from_scanner
+        for key in list(self._selector.get_map().values()):
+            if key.fileobj not in wanted:
+                self._selector.unregister(key.fileobj)
+        for fileobj, handler in wanted.items():
+            if fileobj not in self._selector.get_map():
+                self._selector.register(fileobj, selectors.EVENT_READ, handler)
+
+    def _send_to_scanner(self, msg):
+        self._connect_scanner()
+        self.clientConn.sendall(msg)
+        if self.DEBUGLEVEL >= 3:
+            self._log(3, 'sent     %4d bytes to   scanner', len(msg))
+            # msg may be a view of a receive buffer, the log record is formatted later
+            self._log(3, '%s', HexDump(bytes(msg), max_lines=1))
+
+    def _accept(self):
+        self.server_conn, self.server_conn_addr = self.server.accept()
+        self.nr_connect += 1
+        self._log(2, 'Accepted connection nr. %d from: %s', self.nr_connect, self.server_conn_addr)
+        # (re)connect with scanner (proxy as client) if necessary
+        self._connect_scanner()
+
+    def _from_workstation(self):
+        try:
+            from_ws = self._ws_view[:self.server_conn.recv_into(self._ws_buffer)]
+        except ConnectionResetError:
+            from_ws = None
+        if not from_ws:
+            # workstation closed the connection
+            self._log(2, 'Connection nr. %d closed', self.nr_connect)
+            self._close_workstation()
+            return
+        self._log(3, 'received %4d bytes from workstation', len(from_ws))
+        if from_ws == self.ERROR_3BYTE_MSG:
+            # connected workstation too early before file chunk was complete:
+            #     don't send these 3 bytes to scanner, continue with scanner as if nothing happened
+            self._log(3, 'connected workstation too early, returning to communication with scanner')
+            return
+        # special intermediate packages needed to be sent after the answer to INIT_MSG1/2
+        if from_ws == self.INIT_MSG1:
+            self._inject = self.SPEC_MSG
+        elif from_ws == self.INIT_MSG2:
+            self._inject = self.NEXT_PAGE_REQUEST
+        self._send_to_scanner(from_ws)
+
+    def _from_scanner(self):
+        size = self.clientConn.recv_into(self._scanner_buffer)
+        if not size:
+            self._log(1, 'Scanner closed the connection')
+            self._close_scanner()
+            self._close_workstation()
+            return
+        from_scanner = self._scanner_view[:size]
+        if self.DEBUGLEVEL >= 3:
+            self._log(3, 'received %4d bytes from scanner', size)
+            self._log(3, '%s', HexDump(bytes(from_scanner), max_lines=1))
+        if self._intercept is not None:
+            self._intercept(from_scanner)
+            return
+        self.server_conn.sendall(from_scanner)
+        self._log(3, 'sent     %4d bytes to   workstation', size)
+        if self._inject is not None:
+            # the answer has no length, it ends when the scanner stays quiet (longer after a full packet)
+            idle = self.ANSWER_IDLE_AFTER_FULL if size == self.BUFFERSIZE else self.ANSWER_IDLE
+            self._timer = (time.monotonic() + idle, self._send_inject)
+
+    def _send_inject(self):
+        self._send_to_scanner(self._inject)
+        self._inject = None
+        # the answer is not meant for the workstation
+        self._intercept = self._drop_answer
+
+    def _from_control(self):
+        try:
+            opcode, seq = self.control.recv()
+        except EOFError:
+            self._stoprequest.set()
+            return
+        if opcode == ProxyControl.CHECK_PAGE:
+            self._page_check = seq
+            self._intercept = self._page_status
+            self._ask_next_page()
+        elif opcode == ProxyControl.CANCEL and seq == self._page_check:
+            self._log(1, 'page check cancelled')
+            self._page_check = self._timer = None
+            # the answer to a NEXT_PAGE_REQUEST still on its way is not meant for the workstation
+            self._intercept = self._drop_answer if self._page_asked else None
+
+    def _ask_next_page(self):
+        self._log(3, 'checking if there are more pages to come ...')
+        self._send_to_scanner(self.NEXT_PAGE_REQUEST)
+        self._page_asked = True
+        self._timer = (time.monotonic() + self.PAGE_CHECK_TIMEOUT, self._ask_next_page)
+
+    def _page_status(self, from_scanner):
+        self._timer = None
+        self._page_asked = False
+        if from_scanner == self.PLEASE_WAIT:
+            self._log(3, '"please wait"')
+            self._timer = (time.monotonic() + self.PLEASE_WAIT_DELAY, self._ask_next_page)
+            return
+        elif from_scanner == self.YES_NEW_PAGE:
+            result = ProxyControl.NEW_PAGE
+            self._log(1, '"yes new page"')
+        elif from_scanner == self.NO_MORE_PAGES or from_scanner == self.CANCELING:
+            result = ProxyControl.NO_MORE_PAGES
+            self._log(1, '"no more pages"')
+        else:
+            self._log(1, 'could not interpret answer from scanner,\n%s\nretrying ...', HexDump(bytes(from_scanner)))
+            self._ask_next_page()
+            return
+        self._intercept = None
+        self.control.send(result, self._page_check)
+        self._page_check = None
+
+    def _drop_answer(self, from_scanner):
+        self._page_asked = False
+        self._intercept = None
+
+    def _handle(self, handler):
+        try:
+            handler()
+        except socket.error as e:
+            self._log(1, 'Connection problem: %s', e)
+            self._close_workstation()
+            self._close_scanner()
+            self._inject = self._intercept = self._timer = None
+            self._page_asked = False
+            if self._page_check is not None:
+                # the scanner can not tell anymore, do not let SANE wait for it
+                self.control.send(ProxyControl.NO_MORE_PAGES, self._page_check)
+                self._page_check = None
+
+    def serve(self):
+        self._log(1, 'Initating server listening on port %d (%s) ...', self.PORT, self.PROTOCOL)
+        self._selector = selectors.DefaultSelector()
+        # every step is started by a packet or a message of SANE, the timeout is only
+        #     needed to check if _stoprequest is set
         while not self._stoprequest.is_set():
-            try:
-                self.server_conn, self.server_conn_addr = self.server.accept()
-            except socket.timeout:
-                continue
-            self.server_conn.settimeout(1.0)
-            self._printLog(2, 'Accepted connection nr. %d from:' % nr_connect, self.server_conn_addr)
-            # (re)connect with scanner (proxy as client) if necessary
-            while not self._stoprequest.is_set():
-                try:
-                    self.clientConn.connect((self.SCANNER_IP, self.PORT))
-                except socket.error as e:
-                    # already connected, no need to reconnect
-                    if e.errno == errno.EISCONN:
-                        pass
-                    else:
-                        raise
-                else:
-                    self.clientConn.settimeout(None)
-                    self._printLog(1, 'Initiated client connection to scanner port %d (%s) ...' %
-                                   (self.PORT, self.PROTOCOL))
-                try:
-                    self.clientConn.send('')
-                except socket.error as e:
-                    # broken pipe error (remote disconnect (or not yet connected)) or
-                    #     bad file descriptor (socket already closed by self)
-                    if e.errno in [errno.EPIPE, errno.EBADF]:
-                        self.clientConn.close()
-                        self.clientConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        continue
-                    else:
-                        raise
-                break
-            # actual start: get package from workstation and send to scanner
-            #     loop back here continuously to check if _stoprequest is set
-            while not self._stoprequest.is_set():
-                try:
-                    try:
-                        from_ws = self.server_conn.recv(self.BUFFERSIZE)
-                    except socket.timeout:
-                        try:
-                            # blocking Queue.get call that times out after 50 ms
-                            query = self.queryQ.get(True, 0.05)
-                        except queue.Empty:
-                            continue
-                        if query == 'check if page is coming':
-                            result = self._check_next_page_status()
-                            if result:
-                                self.resultQ.put(result)
-                        continue
-                    except socket.error as e:
-                        # connection reset by peer
-                        if e.errno == errno.ECONNRESET:
-                            self.server_conn.close()
-                            break
-                        else:
-                            raise
-                    self.server_conn.settimeout(None)
-                    self._printLog(3, 'received %4d bytes from workstation' % (len(from_ws)))
-                    if HexMessage(from_ws, raw_in=True) == error3byte_msg:
-                        self._printLog(3, error3byte_msg)
-                        # connected workstation too early before file chunk was complete
-                        raise ProxyError('connected workstation too early, returning to communication with scanner')
-                except ProxyError as e:
-                    self._printLog(3, 'ProxyError:', e)
-                    pass  # did't send these 3 bytes to scanner, continue with scanner as if nothing happened
-                else:
-                    sent_size_client = self.clientConn.send(from_ws)
-                    self._printLog(3, 'sent     %4d bytes to   scanner' % sent_size_client)
-                    self._printLog(3, str(HexMessage(from_ws, raw_in=True)).split('\n')[0])
-                    if sent_size_client == 0:
-                        nr_connect += 1
-                        self.server_conn.close()
-                        break
-                # 250 ms timeout for (all but 1st) data packages from scanner to come in
-                self.clientConn.settimeout(0.25)
-                sent_sizeserver = 0
-                retry_after1240 = 0
-                sending_file = False
-                # get package from scanner and send to workstation
-                #     loop if not timed out -> sending a file
-                while not self._stoprequest.is_set():
-                    try:
-                        from_scanner = self.clientConn.recv(self.BUFFERSIZE)
-                        self._printLog(3, 'received %4d bytes from scanner' % (len(from_scanner)))
-                    except socket.timeout:
-                        # endless retry if the 1st package was timed out (effectively no timeout at all for 1st package)
-                        if not sending_file:
-                            continue
-                        # retry 2 times if last package was 1240 bytes (effectively 3*250ms = 0.75s timeout
-                        #     for these 1240 bytes follow up packages)
-                        if sent_sizeserver == 1240 and retry_after1240 < 3:
-                            retry_after1240 += 1
-                            continue
-                        sending_file = False
-                        self.clientConn.settimeout(None)
-                        break
-                    retry_after1240 = 0
-                    sent_sizeserver = self.server_conn.send(from_scanner)
-                    self._printLog(3, 'sent     %4d bytes to   workstation' % sent_sizeserver)
-                    self._printLog(3, str(HexMessage(from_scanner, raw_in=True)).split('\n')[0])
-                    sending_file = True  # after 1st data package
-                # special intermediate packages needed to be sent during the beginning after init_msg1/2
-                from_ws_hx_msg = HexMessage(from_ws, raw_in=True)
-                if from_ws_hx_msg in [init_msg1, init_msg2]:
-                    if from_ws_hx_msg == init_msg1:
-                        to_send = spec_msg
-                    elif from_ws_hx_msg == init_msg2:
-                        to_send = self.npRequest
-                    sent_size_client = self.clientConn.send(to_send.get_msg())
-                    self._printLog(3, 'sent     %4d bytes to   scanner' % sent_size_client)
-                    self._printLog(3, str(to_send).split('\n')[0])
-                    from_scanner = self.clientConn.recv(self.BUFFERSIZE)
-                    self._printLog(3, 'received %4d bytes from scanner' % (len(from_scanner)))
-                    self._printLog(3, str(HexMessage(from_scanner, raw_in=True)).split('\n')[0])
-                self.server_conn.settimeout(1.0)
+            self._update_selector()
+            timeout = 1.0
+            if self._timer:
+                timeout = min(timeout, max(0.0, self._timer[0] - time.monotonic()))
+            for key, _ in self._selector.select(timeout):
+                self._handle(key.data)
+                if self._selector_state != self._state():
+                    break  # the other events may belong to sockets not wanted anymore
+            if self._timer and self._timer[0] <= time.monotonic():
+                handler = self._timer[1]
+                self._timer = None
+                self._handle(handler)
         # execute when process is joined (closed)
-        try:
-            self.server_conn.close()
-        except AttributeError:
-            pass
+        self._selector.close()
+        self._close_workstation()
+        self._close_scanner()
         self.server.close()
-        self.clientConn.close()
-        self._printLog(1, 'closed!')
+        self._log(1, 'closed!')
 
 
 # t-k: modifications to sane module's scanner handling
-class _ModSaneIterator(sane._SaneIterator):
+#     mixins for the classes of python-sane, see sane_subclass()
+class _ModSaneIterator(object):
     """
     modified next method communicating with TCP proxy subprocess
     to enable multipage scanning
     """
 
     def __init__(self, device):
-        sane._SaneIterator.__init__(self, device)
+        super(_ModSaneIterator, self).__init__(device)
         self.iteration = 0
 
     def __next__(self):
         try:
             if self.iteration != 0:
                 print('Another page coming?')
-                # tell TCP proxy to ...
-                query_q.put('check if page is coming')
-                # get result back, with blocking Queue.get call
-                result = result_q.get(True)
+                # ask TCP proxy of this scanner
+                try:
+                    page_coming = self.device.scanner.page_coming(PAGE_QUERY_TIMEOUT)
+                except (socket.timeout, EOFError) as e:
+                    print('No answer from TCP proxy whether another page is coming (%s), ending scan' % e,
+                          file=sys.stderr)
+                    page_coming = False
                 self.device.cancel()
-                if result == 'yes new page':
-                    pass
-                elif result == 'no more pages':
+                if not page_coming:
                     raise StopIteration
             self.device.start()
         except sane.error as v:
@@ -1432,100 +3170,170 @@ class _ModSaneIterator(sane._SaneIterator):
         return self.__next__()
 
 
-class ModSaneDev(sane.SaneDev):
+class ModSaneDev(object):
     """
     use modified _SaneIterator class
     """
 
     def multi_scan(self):
-        return _ModSaneIterator(self)
+        return sane_subclass('_SaneIterator', _ModSaneIterator)(self)
 
 
-def modsaneopen(devname):
+def snap_in_bands(dev, no_cancel=False, transpose=None, progress=None, band_lines=None):
     """
-    Open a device for scanning using modified SaneDev class
+    read the page from the handle dev of python-sane (>= 2.9) like SaneDev.snap(), but
+    turn the scan data into the image in bands of band_lines (SCAN_BAND_LINES) lines:
+    from the last line up, every band is transposed (None or Image.Transpose.ROTATE_270)
+    and pasted and the scan data behind it is given back. SaneDev.snap() holds the scan
+    data, a copy of it and the image at once, rotating the image later adds another one.
     """
-    new = ModSaneDev(devname)
-    return new
+    from PIL import Image
+    data, width, height, samples, _ = dev.snap(no_cancel, False, progress)
+    if not data:
+        raise RuntimeError("Scanner returned no data")
+    mode = 'RGB' if samples == 3 else 'L'
+    line_size = width * samples
+    band_lines = max(1, band_lines or SCAN_BAND_LINES)
+    # not filled: the memory of the image is taken as the bands are pasted
+    im = Image.new(mode, (height, width) if transpose else (width, height), None)
+    bottom = height
+    while bottom > 0:
+        top = max(0, bottom - band_lines)
+        with memoryview(data) as view, view[top * line_size:bottom * line_size] as band_data:
+            band = Image.frombytes(mode, (width, bottom - top), band_data)
+        if transpose:
+            im.paste(band.transpose(transpose), (height - bottom, 0))
+        else:
+            im.paste(band, (0, top))
+        # the bytearray gives its memory back whenever less than half of it is used
+        del data[top * line_size:]
+        bottom = top
+    return im
 
 
-# ################################ MAIN #################################
+class BandSaneDev(object):
+    """
+    read the pages with snap_in_bands(), transposed by band_transpose
+    """
 
+    band_transpose = None
 
-if __name__ == '__main__':
+    def snap(self, no_cancel=False, progress=None):
+        return snap_in_bands(self.dev, no_cancel, self.band_transpose, progress)
 
-    # Calculate "ID" based on SERVER_NAME and hostname
-    # t-k: use md5 hashing to get real unique IDs that take into account
-    #     the whole strings rather than just the last 8 letters
-    SERVER_UID = server_uid_gen()
 
-    while True:
-        try:
-            SERVER_INSTANCE_ID = server_register()
-        except Exception as e:
-            logging.exception("Network or scanner not available (%s): waiting 10s and trying again ..." % e)
-            time.sleep(10)  # Wait 10 seconds
-        else:
-            break
+def band_snap_supported():
+    """
+    snap_in_bands() needs the scan data python-sane returns since version 2.9
+    """
+    version = getattr(import_sane(), '__version__', '0')
+    return tuple(int(part) for part in re.findall(r'\d+', version)[:2]) >= (2, 9)
 
-    # Unregister #t-k: with new function - easier to understand
-    print('At program termination unregistering server with:\n' + ' ' * 4 +
-          str(atexit.register(server_unregister)))
 
-    # t-k: initiate queues for communication with subprocesses and
-    #     start the proxy server processes
-    if MODIFIED_SANE:
+saneSubclasses = {}
 
-        def init_qs():
-            global query_q, result_q
-            query_q, result_q = multiprocessing.Queue(), multiprocessing.Queue()
 
+def sane_subclass(base_name, *mixins):
+    """
+    return the class made of mixins and the class base_name of python-sane
+    """
+    if (base_name,) + mixins not in saneSubclasses:
+        saneSubclasses[(base_name,) + mixins] = type(''.join(mixin.__name__ for mixin in mixins) or base_name,
+                                                     mixins + (getattr(import_sane(), base_name),), {})
+    return saneSubclasses[(base_name,) + mixins]
 
-        init_qs()
 
+def modsaneopen(devname, scanner, mixins=()):
+    """
+    Open a device for scanning using modified SaneDev class,
+    talking to the TCP proxy of scanner
+    """
+    new = sane_subclass('SaneDev', ModSaneDev, *mixins)(devname)
+    new.scanner = scanner
+    return new
 
-        def start_proxies():
-            global proxies
-            while True:
-                try:
-                    proxies = [UDProxy(), TCProxy(query_q, result_q)]
-                except socket.error as e:
-                    if e.errno == errno.EADDRINUSE:  # address already in use
-                        print('TCP proxy was restarted too soon, waiting 10s ...')
-                        time.sleep(10)
-                    else:
-                        raise
-                else:
-                    break
-            for p in proxies:
-                p.start()
 
+# ################################ MAIN #################################
 
-        start_proxies()
 
-        # angelnu proxies not defined without MODIFIED_SANE
+def register_server(registration):
+    while True:
+        try:
+            registration.instance_id = server_register(registration)
+        except Exception as e:
+            logging.exception("Network or scanner not available (%s): waiting 10s and trying again ..." % e)
+            time.sleep(10)  # Wait 10 seconds
+        else:
+            return
 
-        def exit_proxies():
-            global proxies
-            for p in proxies:
-                p.join()
 
+def serve_scanner(scanner):
+    """
+    register the servers of scanner and keep scanning with it
+    """
+    # the servers are registered while the proxies start and SANE connects, scanning
+    #     only waits for the registrations (a job waits for SANE in get_sane_instance)
+    startup = StartupTasks()
+    for registration in scanner.registrations:
+        startup.add('register %s on %s' % (registration.name, scanner.ip), register_server, registration)
 
-        print('At program termination joining proxy processes with:\n' + ' ' * 4 +
-              str(atexit.register(exit_proxies)))
+    # t-k: start the proxy server processes
+    if MODIFIED_SANE:
+        startup.add('proxies for %s' % scanner.ip, scanner.start_proxies)
 
     # angelnu Test the Sane connection (also works as a chache to be ready at scan time)
     # t-k: can only do this after proxies are established if modified sane method is used
     #     + only applicable if one server is used
     if SCANNER_CACHING:
-        if not get_sane_instance():
-            print("Could not connect to Scanner (" + SCANNER_SANE_NAME + ") via SANE.", file=sys.stderr)
-            sys.exit(1)
+        startup.add('SANE for %s' % scanner.ip, get_sane_instance, scanner,
+                    depends=['proxies for %s' % scanner.ip] if MODIFIED_SANE else [], fatal=True)
+
+    for registration in scanner.registrations:
+        startup.result('register %s on %s' % (registration.name, scanner.ip))
+    if MODIFIED_SANE:
+        startup.result('proxies for %s' % scanner.ip)
+    print('Serving scanner %s %.2fs after start, memory: %s' % (scanner.ip, time.monotonic() - IMPORT_START,
+                                                                 memory_report()))
 
     # Main program: keep scanning
     while True:
         try:
-            scann_worker()
+            scann_worker(scanner)
+        except ConfigError as e:
+            print('Scanner %s: %s, exiting ...' % (scanner.ip, e), file=sys.stderr)
+            fatal_error.set()
+            return
         except Exception:
             logging.exception("Something awful happened! Waiting 10 seconds before trying again.")
             time.sleep(10)  # Wait 10 seconds
+
+
+def exit_proxies_all(scanners):
+    for scanner in scanners:
+        scanner.exit_proxies()
+
+
+if __name__ == '__main__':
+
+    # Unregister #t-k: with new function - easier to understand
+    print('At program termination unregistering servers with:\n' + ' ' * 4 +
+          str(atexit.register(server_unregister_all, SCANNER_SESSIONS)))
+
+    # angelnu proxies not defined without MODIFIED_SANE
+    if MODIFIED_SANE:
+        print('At program termination joining proxy processes with:\n' + ' ' * 4 +
+              str(atexit.register(exit_proxies_all, SCANNER_SESSIONS)))
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_ADDRESS, METRICS_PORT)
+        print('Serving metrics on http://%s:%d/metrics' % (METRICS_ADDRESS, METRICS_PORT))
+
+    # every scanner is served by its own thread, the main thread only waits for signals
+    scanner_threads = []
+    for scanner in SCANNER_SESSIONS:
+        scanner_thread = threading.Thread(target=serve_scanner, args=(scanner,), name=scanner.ip, daemon=True)
+        scanner_thread.start()
+        scanner_threads.append(scanner_thread)
+    while any(scanner_thread.is_alive() for scanner_thread in scanner_threads):
+        if fatal_error.wait(1.0):
+            sys.exit(1)
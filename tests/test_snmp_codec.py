@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# test_snmp_codec.py
+# Tests of the built-in SNMP codec of samsungScannerServer against hand-encoded datagrams,
+# run with "python3 -m pytest tests" or "python3 -m unittest discover tests"
+#
+# Copyright (C) 2022-2023 Steffen Klee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ast
+import os
+import socket
+import threading
+import types
+import unittest
+
+DAEMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'samsungScannerServer.py')
+
+# scan status OID of InstanceID 27
+STATUS_OID = (1, 3, 6, 1, 4, 1, 236, 11, 5, 11, 81, 11, 7, 2, 1, 2, 27)
+STATUS_OID_BER = bytes.fromhex('0611 2b06010401816c0b050b510b070201021b')
+
+# The datagrams below are encoded by hand following RFC 1157 (not captured from a scanner)
+
+# SNMPv1 GET of the scan status of InstanceID 27, community 'public', request id 1
+GET_REQUEST = bytes.fromhex(
+    '3032 020100 0406' + b'public'.hex() +
+    'a025 020400000001 020100 020100 3017 3015' + STATUS_OID_BER.hex() + '0500')
+
+# the reply to it: the user selected the server (scan status 1)
+GET_RESPONSE = bytes.fromhex(
+    '3034 020100 0406' + b'public'.hex() +
+    'a227 020400000001 020100 020100 3019 3017' + STATUS_OID_BER.hex() + '04020100')
+
+
+def get_response(request_id=1, error_status=0, value='04020100', version='00'):
+    """
+    GET_RESPONSE with another request id (< 0x80), error status, BER encoded value or version
+    """
+    var_bind = STATUS_OID_BER + bytes.fromhex(value)
+    var_binds = bytes([0x30, len(var_bind) + 2, 0x30, len(var_bind)]) + var_bind
+    pdu = bytes([0x02, 0x01, request_id, 0x02, 0x01, error_status, 0x02, 0x01, 0x00]) + var_binds
+    message = bytes.fromhex('0201' + version + '0406') + b'public' + bytes([0xa2, len(pdu)]) + pdu
+    return bytes([0x30, len(message)]) + message
+
+
+def load_codec():
+    """
+    the SNMP codec of the daemon: its constants, ber_*/snmp_* functions and RawSnmpClient
+    taken from the source, importing the daemon would read its configuration and start it
+    """
+    with open(DAEMON) as f:
+        tree = ast.parse(f.read(), DAEMON)
+
+    def is_codec(node):
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            return node.name.startswith(('ber_', 'snmp_')) or node.name == 'RawSnmpClient'
+        return (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)
+                and node.targets[0].id.startswith(('BER_', 'SNMP_')))
+
+    module = ast.Module(body=[node for node in tree.body if is_codec(node)], type_ignores=[])
+    codec = types.ModuleType('snmp_codec')
+    codec.socket, codec.threading = socket, threading
+    exec(compile(module, DAEMON, 'exec'), codec.__dict__)
+    return codec
+
+
+codec = load_codec()
+
+
+class TestEncode(unittest.TestCase):
+
+    def test_get_request(self):
+        request, offset = codec.snmp_encode_get_request(b'public', [STATUS_OID], 1)
+        self.assertEqual(request, GET_REQUEST)
+        self.assertEqual(request[offset:offset + 4], b'\x00\x00\x00\x01')
+
+    def test_request_id_offset(self):
+        request, offset = codec.snmp_encode_get_request(b'public', [STATUS_OID, STATUS_OID[:-1] + (28,)])
+        request = bytearray(request)
+        request[offset:offset + 4] = (0x12345678).to_bytes(4, 'big')
+        self.assertEqual(codec.snmp_request_id(request), 0x12345678)
+
+    def test_long_length(self):
+        self.assertEqual(codec.ber_encode_length(0x7f), b'\x7f')
+        self.assertEqual(codec.ber_encode_length(0x80), b'\x81\x80')
+        self.assertEqual(codec.ber_encode_length(0x1234), b'\x82\x12\x34')
+
+    def test_oid(self):
+        self.assertEqual(codec.ber_encode_oid(STATUS_OID), STATUS_OID_BER)
+        self.assertEqual(codec.ber_decode_oid(STATUS_OID_BER[2:]), STATUS_OID)
+
+
+class TestDecode(unittest.TestCase):
+
+    def test_get_response(self):
+        self.assertEqual(codec.snmp_decode_get_response(GET_RESPONSE),
+                         (1, 0, [(STATUS_OID, codec.BER_OCTET_STRING, b'\x01\x00')]))
+
+    def test_memoryview(self):
+        self.assertEqual(codec.snmp_decode_get_response(memoryview(GET_RESPONSE)),
+                         codec.snmp_decode_get_response(GET_RESPONSE))
+
+    def test_error_status(self):
+        # noSuchName
+        self.assertEqual(codec.snmp_decode_get_response(get_response(error_status=2))[1], 2)
+
+    def test_values_of_other_types(self):
+        # Integer, Null and the noSuchInstance exception of SNMPv2c
+        for value, tag, content in (('020105', 0x02, b'\x05'), ('0500', 0x05, b''), ('8100', 0x81, b'')):
+            with self.subTest(value=value):
+                _, _, var_binds = codec.snmp_decode_get_response(get_response(value=value))
+                self.assertEqual(var_binds, [(STATUS_OID, tag, content)])
+
+    def test_truncated(self):
+        for length in (0, 1, 2, 10, len(GET_RESPONSE) // 2, len(GET_RESPONSE) - 1):
+            with self.subTest(length=length):
+                with self.assertRaises(ValueError):
+                    codec.snmp_decode_get_response(GET_RESPONSE[:length])
+
+    def test_garbled(self):
+        for offset, byte in ((0, 0x31), (2, 0x04), (13, 0xa0), (2 + 3 + 8 + 2, 0x04), (1, 0x85)):
+            with self.subTest(offset=offset, byte=byte):
+                data = bytearray(GET_RESPONSE)
+                data[offset] = byte
+                with self.assertRaises(ValueError):
+                    codec.snmp_decode_get_response(data)
+
+    def test_request_id(self):
+        self.assertEqual(codec.snmp_request_id(GET_REQUEST), 1)
+        self.assertEqual(codec.snmp_request_id(GET_RESPONSE), 1)
+        # SNMPv2c
+        self.assertEqual(codec.snmp_request_id(get_response(request_id=42, version='01')), 42)
+
+    def test_request_id_of_other_datagrams(self):
+        # SNMPv3: a header sequence instead of the community
+        v3 = bytes.fromhex('300e 020103 3009 020101 020200ff 040100')
+        for data in (b'', b'\x30', b'GET / HTTP/1.1\r\n', v3, GET_RESPONSE[:20]):
+            with self.subTest(data=data):
+                self.assertIsNone(codec.snmp_request_id(data))
+
+
+class FakeAgent(object):
+    """
+    UDP socket answering every request with the datagrams of reply(request id)
+    """
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(1500)
+            except OSError:
+                return
+            for datagram in self.reply(codec.snmp_request_id(data)):
+                self.sock.sendto(datagram, address)
+
+    def close(self):
+        self.sock.close()
+
+
+class TestRawSnmpClient(unittest.TestCase):
+
+    def query(self, reply, oids=(STATUS_OID,)):
+        agent = FakeAgent(reply)
+        client = codec.RawSnmpClient('127.0.0.1', agent.port, timeout=1.0)
+        try:
+            return client.get_octet_strings(*oids)
+        finally:
+            client.close()
+            agent.close()
+
+    def test_values(self):
+        self.assertEqual(self.query(lambda request_id: [get_response(request_id)]), [b'\x01\x00'])
+
+    def test_late_reply_is_skipped(self):
+        # a reply to an earlier request that timed out comes first
+        replies = lambda request_id: [get_response(request_id + 1, value='04020300'), get_response(request_id)]
+        self.assertEqual(self.query(replies), [b'\x01\x00'])
+
+    def test_no_matching_reply(self):
+        with self.assertRaises(socket.timeout):
+            self.query(lambda request_id: [get_response(request_id + 1)])
+
+    def test_error_status(self):
+        with self.assertRaises(NameError):
+            self.query(lambda request_id: [get_response(request_id, error_status=2)])
+
+    def test_no_such_instance(self):
+        with self.assertRaises(ValueError):
+            self.query(lambda request_id: [get_response(request_id, value='8100')])
+
+    def test_other_oids(self):
+        with self.assertRaises(ValueError):
+            self.query(lambda request_id: [get_response(request_id)], (STATUS_OID[:-1] + (28,),))
+
+
+if __name__ == '__main__':
+    unittest.main()
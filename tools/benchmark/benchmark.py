@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# benchmark.py
+# Runs full scan jobs of samsungScannerServer against the simulated scanner of fakeScanner.py
+# and reports button-press-to-file latency, pages per second, CPU time and peak RSS
+#
+# Copyright (C) 2022-2023 Steffen Klee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+from fakeScanner import FakeSaneDevice, FakeScanner
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# configuration of the daemon: the shipped one with the scanner, owner and output replaced
+CONFIG = """
+exec(compile(open(%(shipped)r).read(), %(shipped)r, 'exec'))
+ENABLED_SERVER = True
+MODIFIED_SANE = False
+LOG_NAME = None
+DISCOVERY_CACHE = %(cache)r
+OWNER_UID = %(uid)d
+SERVER_NAME = 'benchmark'
+OUTPUT_PREFIX = %(output)r
+OPTIONS = [{'name': 'benchmark', 'color': %(color)r, 'resolution': 'DPI_%(dpi)d', 'format': %(format)r,
+            'size': %(size)r, 'output': OUTPUT_PREFIX, 'filters': []}]
+SCANNERS = [{'sane_name': 'smfp:SAMSUNG CLX-3300 Series on %(ip)s',
+             'http_port': %(http_port)d, 'snmp_port': %(snmp_port)d}]
+%(settings)s
+"""
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def import_server(work_dir, fake, settings=(), color='COLOR_GRAY', dpi=300, format='FORMAT_M_PDF', size='SIZE_A4'):
+    """
+    import samsungScannerServer configured for the fake scanner, its configuration is read from work_dir
+    """
+    with open(os.path.join(work_dir, 'samsungScannerServer.conf'), 'w') as f:
+        f.write(CONFIG % {'shipped': os.path.join(REPO_DIR, 'etc', 'samsungScannerServer.conf'),
+                          'uid': os.getuid(), 'output': os.path.join(work_dir, 'Scans', 'SCAN_${date}__${uid}'),
+                          'cache': os.path.join(work_dir, 'discovery.json'),
+                          'color': color, 'dpi': dpi, 'format': format, 'size': size, 'ip': fake.ip,
+                          'http_port': fake.http_port, 'snmp_port': fake.snmp_port, 'settings': '\n'.join(settings)})
+    os.chdir(work_dir)
+    sys.argv = [os.path.join(REPO_DIR, 'samsungScannerServer.py')]
+    sys.path.insert(0, REPO_DIR)
+    import samsungScannerServer
+    return samsungScannerServer
+
+
+def run_job(server, scanner, fake, registration):
+    """
+    run scann_worker and press the button once it waits for the job,
+    return (seconds from pressing the button to the last file written, files written)
+    """
+    result = {}
+
+    def worker():
+        try:
+            result['files'] = server.scann_worker(scanner)
+        finally:
+            result['end'] = time.perf_counter()
+
+    thread = threading.Thread(target=worker, name='scann_worker')
+    requests = fake.snmp_requests
+    thread.start()
+    # the daemon polls the scan status once it waits for a job
+    while fake.snmp_requests == requests and thread.is_alive():
+        time.sleep(0.01)
+    start = time.perf_counter()
+    fake.press_button(registration.instance_id)
+    thread.join()
+    if 'files' not in result:
+        raise RuntimeError('scan job failed')
+    return result['end'] - start, result['files']
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]",
+                          description="Run scan jobs of samsungScannerServer against a simulated scanner.")
+    parser.add_option("--jobs", type="int", dest="jobs", default=5,
+                      help="Number of scan jobs [default: %default]")
+    parser.add_option("--pages", type="int", dest="pages", default=5,
+                      help="Pages per scan job [default: %default]")
+    parser.add_option("--dpi", type="int", dest="dpi", default=300,
+                      help="Resolution of the pages [default: %default]")
+    parser.add_option("--color", dest="color", default='COLOR_GRAY',
+                      help="COLOR_MONO, COLOR_GRAY or COLOR_TRUE [default: %default]")
+    parser.add_option("--format", dest="format", default='FORMAT_M_PDF',
+                      help="File format as offered by the scanner [default: %default]")
+    parser.add_option("--size", dest="size", default='SIZE_A4',
+                      help="Page size as offered by the scanner [default: %default]")
+    parser.add_option("--scanDelay", type="float", dest="scanDelay", default=0.0,
+                      help="Seconds the simulated scanner needs per page [default: %default]")
+    parser.add_option("--selectionDelay", type="float", dest="selectionDelay", default=0.0,
+                      help="Seconds the simulated user needs to choose an option [default: %default]")
+    parser.add_option("--set", action="append", dest="settings", default=[], metavar="SETTING=VALUE",
+                      help="Configuration line to use for the daemon, e.g. --set PAGE_WORKERS=4 (repeatable)")
+    parser.add_option("--keep", action="store_true", dest="keep",
+                      help="Keep the working directory with the scanned files")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose",
+                      help="Show the output of the daemon")
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.error("incorrect number of arguments")
+
+    fake = FakeScanner(selection_delay=options.selectionDelay).start()
+    work_dir = tempfile.mkdtemp(prefix='samsungScannerServer-benchmark-')
+    quiet = contextlib.nullcontext() if options.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    try:
+        import_start = time.perf_counter()
+        with quiet:
+            server = import_server(work_dir, fake, options.settings, options.color, options.dpi, options.format,
+                                   options.size)
+        import_seconds = time.perf_counter() - import_start
+        import_memory = server.memory_report()
+        with quiet:
+            scanner = server.SCANNER_SESSIONS[0]
+            registration = scanner.registrations[0]
+            registration.instance_id = server.server_register(registration)
+            # the daemon reads the pages of python-sane >= 2.9 in bands unless SCAN_BAND_LINES is 0
+            device_class = FakeSaneDevice
+            if server.SCAN_BAND_LINES:
+                device_class = type('FakeBandSaneDevice', (server.BandSaneDev, FakeSaneDevice), {})
+            scanner.sane_dev = device_class(options.pages, options.scanDelay)
+            server.autoconfig_dic(scanner, 'SIZE2SANE', 'Size', 'rotated')
+
+        latencies = []
+        pages = 0
+        cpu = cpu_seconds()
+        for job in range(options.jobs):
+            with quiet:
+                latency, files = run_job(server, scanner, fake, registration)
+            latencies.append(latency)
+            pages += options.pages
+            print('job %d: %.3fs from button to file, %d file(s)' % (job + 1, latency, len(files)))
+        cpu = cpu_seconds() - cpu
+
+        with quiet:
+            server.server_unregister_all(server.SCANNER_SESSIONS)
+    finally:
+        fake.stop()
+        if options.keep:
+            print('Scanned files kept in %s' % work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+    print('%d job(s) of %d page(s), %s, %d dpi, %s' % (options.jobs, options.pages, options.color, options.dpi,
+                                                        options.format))
+    print('latency:  median %.3fs, min %.3fs, max %.3fs' % (statistics.median(latencies), min(latencies),
+                                                              max(latencies)))
+    print('import:   %.3fs, %s' % (import_seconds, import_memory))
+    print('pages/s:  %.2f' % (pages / sum(latencies)))
+    print('stages:   ' + ', '.join('%s %.3fs' % (stage, seconds / options.jobs)
+                                   for stage, (count, seconds) in server.metrics.stages.items()
+                                   if stage not in ('register', 'wait_selected')) + ' per job')
+    # includes the simulated scanner running in the same process
+    print('CPU:      %.3fs (%.3fs per page)' % (cpu, cpu / pages))
+    print('peak RSS: %.1f MiB (filter processes %.1f MiB)' % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# encoderBenchmark.py
+# Encodes synthetic scanned pages with every encoder profile of samsungScannerServer (ENCODER_PROFILES)
+# and reports the bytes per page and the encode time per page
+#
+# Copyright (C) 2022-2023 Steffen Klee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+from PIL import Image
+
+from benchmark import import_server
+from fakeScanner import FakeScanner, page_format_size, synthetic_page
+
+COLORS = {'COLOR_MONO': '1', 'COLOR_GRAY': 'L', 'COLOR_TRUE': 'RGB'}
+FORMATS = {'pdf': 'PDF', 'jpg': 'JPEG', 'tiff': 'TIFF'}
+
+
+def scanned_page(mode, dpi, noise):
+    """
+    synthetic A4 page in mode, with some noise like the paper texture of a real scan
+    """
+    size = page_format_size('A4 - 210x297 mm', dpi)
+    page = synthetic_page('L', size, dpi, 1)
+    if noise:
+        page = Image.blend(page, Image.effect_noise(size, 64), noise)
+    if mode == 'RGB':
+        page = Image.merge('RGB', (page, page, page.point(lambda value: min(255, value + 20))))
+    elif mode == '1':
+        # line art is thresholded by the scanner
+        page = page.convert('1', dither=Image.Dither.NONE)
+    return page
+
+
+def measure(server, page, color, profile, extension, dpi, rounds):
+    """
+    encode page rounds times like scan_and_save, return (bytes per page, seconds per page)
+    """
+    bilevel, params = server.encoder_profile({'color': color, 'encoder': profile})
+    size = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        im = server.to_bilevel(page) if bilevel else page
+        f = io.BytesIO()
+        if extension == 'pdf':
+            im.save(f, 'PDF', resolution=dpi, **server.save_params_for(im.mode, params, extension))
+        else:
+            im.save(f, FORMATS[extension], dpi=(dpi, dpi), **server.save_params_for(im.mode, params, extension))
+        size += f.tell()
+    return size / rounds, (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]",
+                          description="Compare the encoder profiles of samsungScannerServer.")
+    parser.add_option("--dpi", type="int", dest="dpi", default=300,
+                      help="Resolution of the pages [default: %default]")
+    parser.add_option("--rounds", type="int", dest="rounds", default=3,
+                      help="Pages to encode per profile, color and format [default: %default]")
+    parser.add_option("--noise", type="float", dest="noise", default=0.05,
+                      help="Share of noise in the pages, 0 for perfectly clean pages [default: %default]")
+    parser.add_option("--format", action="append", dest="formats", choices=list(FORMATS),
+                      help="File format to compare: pdf, jpg or tiff (repeatable) [default: all]")
+    parser.add_option("--set", action="append", dest="settings", default=[], metavar="SETTING=VALUE",
+                      help="Configuration line to use for the daemon, e.g. to add a profile to ENCODER_PROFILES "
+                           "(repeatable)")
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.error("incorrect number of arguments")
+
+    fake = FakeScanner()
+    work_dir = tempfile.mkdtemp(prefix='samsungScannerServer-benchmark-')
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            server = import_server(work_dir, fake, options.settings)
+    finally:
+        shutil.rmtree(work_dir)
+
+    print('%d dpi A4 pages, noise %.2f, %d round(s)' % (options.dpi, options.noise, options.rounds))
+    print('%-10s %-10s %-5s %12s %10s' % ('color', 'profile', 'fmt', 'KiB/page', 'ms/page'))
+    for color, mode in COLORS.items():
+        page = scanned_page(mode, options.dpi, options.noise)
+        for profile in server.ENCODER_PROFILES:
+            for extension in options.formats or FORMATS:
+                try:
+                    size, seconds = measure(server, page, color, profile, extension, options.dpi, options.rounds)
+                except Exception as e:
+                    print('%-10s %-10s %-5s %s' % (color, profile, extension, 'failed: %s' % e))
+                    continue
+                print('%-10s %-10s %-5s %12.1f %10.1f' % (color, profile, extension, size / 1024, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# fakeScanner.py
+# Simulated Samsung MFP for benchmarking samsungScannerServer without a printer:
+# the "scan to PC" CGI (HTTP), the scan status agent (SNMP) and a SANE device
+#
+# Copyright (C) 2022-2023 Steffen Klee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageDraw
+
+# scan status of an InstanceID: 1.3.6.1.4.1.236.11.5.11.81.11.7.2.1.2.<InstanceID>
+SCAN_STATUS_OID = (1, 3, 6, 1, 4, 1, 236, 11, 5, 11, 81, 11, 7, 2, 1, 2)
+SYS_DESCR_OID = (1, 3, 6, 1, 2, 1, 1, 1, 0)
+SYS_DESCR = b'Samsung CLX-3300 Series (simulated)'
+
+# scan statuses as seen by samsungScannerServer
+STATUS_IDLE = 0
+STATUS_SELECTED = 1  # user chose the server on the panel
+STATUS_APP_SELECTED = 2  # user chose one of the pushed options
+STATUS_CHOOSING = 3  # options pushed, user is choosing
+
+CAP_SIZES = ['SIZE_A4', 'SIZE_A5', 'SIZE_B5_JIS', 'SIZE_EXECUTIVE', 'SIZE_LETTER', 'SIZE_LEGAL']
+SANE_PAGE_FORMATS = ['A4 - 210x297 mm', 'A5 (Rotated) - 210x148 mm', 'A5 - 148x210 mm', 'B5 (JIS) - 182x257 mm',
+                     'Executive - 7.25"x10.5"', 'Letter - 8.5"x11"', 'Legal - 8.5"x14"']
+SANE_MODES = {'Black and White - Line Art': '1', 'Grayscale - 256 Levels': 'L', 'Color - 16 Million Colors': 'RGB'}
+
+CAP_XML = ('<?xml version="1.0" encoding="UTF-8"?><root><S2PC_Cap>' +
+           ''.join('<Size ID="%s" />' % size for size in CAP_SIZES) +
+           '</S2PC_Cap></root>').encode('utf-8')
+
+
+# Minimal BER codec for the SNMP agent
+
+def ber_length(length):
+    if length < 0x80:
+        return bytes([length])
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(length_bytes)]) + length_bytes
+
+
+def ber_tlv(tag, value):
+    return bytes([tag]) + ber_length(len(value)) + value
+
+
+def ber_integer(value):
+    return ber_tlv(0x02, value.to_bytes(max(1, (value.bit_length() + 8) // 8), 'big', signed=True))
+
+
+def ber_oid(oid):
+    encoded = bytearray([40 * oid[0] + oid[1]])
+    for arc in oid[2:]:
+        chunk = [arc & 0x7f]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7f))
+            arc >>= 7
+        encoded.extend(reversed(chunk))
+    return ber_tlv(0x06, bytes(encoded))
+
+
+def ber_items(data):
+    """
+    return the (tag, value) elements following each other in data
+    """
+    items = []
+    offset = 0
+    while offset < len(data):
+        tag, length = data[offset], data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            size = length & 0x7f
+            length = int.from_bytes(data[offset:offset + size], 'big')
+            offset += size
+        items.append((tag, data[offset:offset + length]))
+        offset += length
+    return items
+
+
+def decode_oid(data):
+    oid = [data[0] // 40, data[0] % 40]
+    arc = 0
+    for byte in data[1:]:
+        arc = (arc << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            oid.append(arc)
+            arc = 0
+    return tuple(oid)
+
+
+class FakeScanner(object):
+    """
+    the network side of a Samsung MFP: the CGI used to register servers, push their options
+    and read the user's selection, CAP.XML and an SNMP agent answering the scan status.
+    press_button() plays the user choosing a server and one of its options on the panel.
+    """
+
+    def __init__(self, ip='127.0.0.1', http_port=0, snmp_port=0, selection_delay=0.0):
+        self.selection_delay = selection_delay
+        self._lock = threading.Lock()
+        self._servers = {}  # UniqueID -> InstanceID
+        self._next_instance_id = 27
+        self._statuses = {}  # InstanceID -> scan status
+        self._pending = None  # (InstanceID, AppIndex) of the button pressed last
+        self._app_list = []
+        self._selected = None
+        self.requests = 0
+        self.snmp_requests = 0
+
+        handler = type('FakeScannerHandler', (FakeScannerHandler,), {'scanner': self})
+        self.http_server = ThreadingHTTPServer((ip, http_port), handler)
+        self.http_server.daemon_threads = True
+        self.snmp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.snmp_socket.bind((ip, snmp_port))
+        self.ip = ip
+        self.http_port = self.http_server.server_address[1]
+        self.snmp_port = self.snmp_socket.getsockname()[1]
+        self._threads = [threading.Thread(target=self.http_server.serve_forever, name='fake-http', daemon=True),
+                         threading.Thread(target=self._serve_snmp, name='fake-snmp', daemon=True)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self.snmp_socket.close()
+
+    def instance_id(self, name):
+        """
+        return the InstanceID of the server registered as name
+        """
+        with self._lock:
+            return self._servers.get(name)
+
+    def press_button(self, instance_id, app_index=1):
+        """
+        select the server instance_id and its option app_index (starting at 1) on the panel
+        """
+        with self._lock:
+            self._pending = (instance_id, app_index)
+            self._statuses[instance_id] = STATUS_SELECTED
+
+    # HTTP
+
+    def register(self, user_id, unique_id, regi_type):
+        with self._lock:
+            if regi_type == 'ADD':
+                if user_id not in self._servers:
+                    self._servers[user_id] = self._next_instance_id
+                    self._next_instance_id += 1
+                instance_id = self._servers[user_id]
+                self._statuses.setdefault(instance_id, STATUS_IDLE)
+                return '<root><S2PC_Regi UserID ="%s" Result="ADD_OK" InstanceID="%d" /></root>' % (
+                    user_id, instance_id)
+            instance_id = self._servers.pop(user_id, 0)
+            self._statuses.pop(instance_id, None)
+            return '<root><S2PC_Regi UserID ="%s" Result="DELETE_OK" InstanceID="%d" /></root>' % (
+                user_id, instance_id)
+
+    def push_app_list(self, app_list):
+        with self._lock:
+            self._app_list = app_list
+            if self._pending is None:
+                return
+            instance_id, app_index = self._pending
+            self._statuses[instance_id] = STATUS_CHOOSING
+        timer = threading.Timer(self.selection_delay, self._select, (instance_id, app_index))
+        timer.daemon = True
+        timer.start()
+
+    def _select(self, instance_id, app_index):
+        with self._lock:
+            if self._pending == (instance_id, app_index):
+                self._selected = app_index
+                self._statuses[instance_id] = STATUS_APP_SELECTED
+
+    def user_select(self):
+        with self._lock:
+            instance_id, app_index = self._pending
+            self._pending = None
+            self._statuses[instance_id] = STATUS_IDLE
+            app = self._app_list[app_index - 1]
+        select = ''.join('<%s Value="%s"/>' % (key, app[key])
+                         for key in ('AppIndex', 'Resolution', 'Color', 'FileFormat', 'ScanSize'))
+        return '<root><S2PC_Select>%s</S2PC_Select></root>' % select
+
+    # SNMP
+
+    def _serve_snmp(self):
+        while True:
+            try:
+                data, address = self.snmp_socket.recvfrom(65535)
+            except OSError:  # closed by stop()
+                return
+            try:
+                response = self.snmp_response(data)
+            except (IndexError, ValueError):
+                continue  # not a GetRequest we understand, a real agent would not answer either
+            self.snmp_socket.sendto(response, address)
+
+    def snmp_response(self, data):
+        (message_tag, message), = ber_items(data)
+        version, community, (pdu_tag, pdu) = ber_items(message)
+        if message_tag != 0x30 or pdu_tag != 0xa0:
+            raise ValueError('not a GetRequest')
+        request_id, error_status, error_index, (_, var_binds) = ber_items(pdu)
+        self.snmp_requests += 1
+        encoded = b''
+        for _, var_bind in ber_items(var_binds):
+            oid = decode_oid(ber_items(var_bind)[0][1])
+            encoded += ber_tlv(0x30, ber_oid(oid) + self.snmp_value(oid))
+        pdu = ber_tlv(*request_id) + ber_integer(0) + ber_integer(0) + ber_tlv(0x30, encoded)
+        return ber_tlv(0x30, ber_tlv(*version) + ber_tlv(*community) + ber_tlv(0xa2, pdu))
+
+    def snmp_value(self, oid):
+        if oid == SYS_DESCR_OID:
+            return ber_tlv(0x04, SYS_DESCR)
+        if oid[:-1] == SCAN_STATUS_OID:
+            with self._lock:
+                status = self._statuses.get(oid[-1])
+            if status is not None:
+                return ber_tlv(0x04, bytes([status, 0, 0, 0]))
+        return ber_tlv(0x81, b'')  # noSuchInstance
+
+
+class FakeScannerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive like the CGI of the scanner
+    scanner = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/IDS/CAP.XML':
+            self.reply(CAP_XML)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.scanner.requests += 1
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # the XML is the single file of the multipart/form-data body
+        m = re.search(rb'(<root>.*</root>)', body, re.DOTALL)
+        root = ET.fromstring(m.group(1)) if m else None
+        if self.path == '/IDS/ScanFaxToPC.cgi' and root is not None and root.find('S2PC_Regi') is not None:
+            regi = root.find('S2PC_Regi').attrib
+            self.reply(self.scanner.register(regi['UserID'], regi['UniqueID'], regi['RegiType']))
+        elif self.path == '/IDS/ScanFaxToPC.cgi' and root is not None and root.find('S2PC_AppList') is not None:
+            self.scanner.push_app_list([{element.tag: element.attrib['Value'] for element in app_list}
+                                        for app_list in root.find('S2PC_AppList')])
+            # the scanner closes the connection without answering
+            self.close_connection = True
+        elif self.path == '/IDS/UserSelect.xml':
+            self.reply(self.scanner.user_select())
+        else:
+            self.send_error(400)
+
+    def reply(self, content):
+        if isinstance(content, str):
+            content = ('<?xml version="1.0" encoding="UTF-8"?>' + content).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+# SANE
+
+class FakeSaneOption(object):
+    def __init__(self, constraint):
+        self.constraint = constraint
+
+
+def page_format_size(page_format, dpi):
+    """
+    return the size in pixels of a page format like 'A4 - 210x297 mm' or 'Letter - 8.5"x11"'
+    """
+    m = re.search(r'([\d.]+)x([\d.]+) ?(mm|")', page_format)
+    width, height = float(m.group(1)), float(m.group(2))
+    per_inch = 25.4 if m.group(3) == 'mm' else 1.0
+    return int(width / per_inch * dpi), int(height / per_inch * dpi)
+
+
+def synthetic_page(mode, size, dpi, number):
+    """
+    a page looking roughly like a letter: white paper, margins, a heading and lines of "text"
+    """
+    im = Image.new('L', size, 255)
+    draw = ImageDraw.Draw(im)
+    margin = dpi
+    line_height = dpi // 6
+    draw.rectangle((margin, margin, size[0] // 2, margin + line_height), fill=30)
+    y = margin + 3 * line_height
+    line = 0
+    while y + line_height < size[1] - margin:
+        # ragged right edge, a new paragraph every few lines
+        width = size[0] - 2 * margin - ((line * 37 + number * 11) % 5) * dpi // 4
+        if line % 7 != 6:
+            for x in range(margin, margin + width, dpi // 3):
+                draw.rectangle((x, y, x + dpi // 4, y + line_height // 2), fill=40 + (x + y) % 60)
+        y += line_height
+        line += 1
+    if mode == 'RGB':
+        im = Image.merge('RGB', (im, im, im.point(lambda value: min(255, value + 20))))
+    elif mode == '1':
+        im = im.convert('1')
+    return im
+
+
+class FakeSaneHandle(object):
+    """
+    stands in for the handle of the SANE device (SaneDev.dev of python-sane >= 2.9),
+    snap() returns the scan data of page
+    """
+
+    def __init__(self):
+        self.page = None
+
+    def snap(self, no_cancel=False, allow16bitsamples=False, progress=None):
+        # line art arrives as 8 bit samples, like from the C code of python-sane
+        page = self.page.convert('L') if self.page.mode == '1' else self.page
+        return bytearray(page.tobytes()), page.width, page.height, len(page.getbands()), 1
+
+
+class FakeSaneDevice(object):
+    """
+    stands in for the SANE device of the scanner: pages are synthetic documents in the
+    mode, resolution and page_format set by samsungScannerServer, scan_delay seconds
+    are spent on every page like the scanner moving the paper
+    """
+
+    def __init__(self, pages=3, scan_delay=0.0):
+        self.pages = pages
+        self.scan_delay = scan_delay
+        self.mode = 'Grayscale - 256 Levels'
+        self.resolution = 300
+        self.page_format = SANE_PAGE_FORMATS[0]
+        self.scans = 0
+        self.dev = FakeSaneHandle()
+
+    def __getitem__(self, key):
+        if key == 'page_format':
+            return FakeSaneOption(SANE_PAGE_FORMATS)
+        if key == 'mode':
+            return FakeSaneOption(list(SANE_MODES))
+        raise KeyError(key)
+
+    def snap(self, no_cancel=False, progress=None):
+        # like SaneDev.snap() of python-sane
+        data, width, height, samples, _ = self.dev.snap(no_cancel, False, progress)
+        mode = 'RGB' if samples == 3 else 'L'
+        return Image.frombuffer(mode, (width, height), bytes(data), 'raw', mode, 0, 1)
+
+    def multi_scan(self):
+        self.scans += 1
+        mode = SANE_MODES[self.mode]
+        size = page_format_size(self.page_format, self.resolution)
+        # drawing every page again would mostly measure this stand-in, not the daemon
+        self.dev.page = synthetic_page(mode, size, self.resolution, self.scans)
+        for _ in range(self.pages):
+            if self.scan_delay:
+                time.sleep(self.scan_delay)
+            yield self.snap(True)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# proxyBenchmark.py
+# Measures the throughput (bytes/s) and the round trip time of the TCP proxy of samsungScannerServer
+# (MODIFIED_SANE) between a simulated workstation and a simulated scanner
+#
+# Copyright (C) 2022-2023 Steffen Klee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+from benchmark import import_server
+from fakeScanner import FakeScanner
+
+SCANNER_IP = '127.0.0.1'
+PROXY_IP = '127.0.0.2'  # any other loopback address, the proxy listens on the port of the scanner
+REQUEST = bytes.fromhex('1b a8 99 00')  # not one of the messages the proxy handles specially
+EXCHANGE = bytes.fromhex('1b a8 98 00')
+EXCHANGE_ANSWER_SIZE = 64
+
+
+def serve_scan_data(server, size):
+    """
+    simulated scanner: answer every request on a connection with size bytes of scan data,
+    a request starting with EXCHANGE with a short answer
+    """
+    data = os.urandom(1 << 20)
+
+    def stream(conn):
+        with conn:
+            while True:
+                request = conn.recv(4096)
+                if not request:
+                    return
+                left = EXCHANGE_ANSWER_SIZE if request.startswith(EXCHANGE) else size
+                while left:
+                    left -= conn.send(memoryview(data)[:min(left, len(data))])
+
+    while True:
+        try:
+            conn, _ = server.accept()
+        except OSError:  # closed when done
+            return
+        threading.Thread(target=stream, args=(conn,), daemon=True).start()
+
+
+def measure(address, size, rounds, pause):
+    """
+    request size bytes rounds times from address, return the bytes/s of every round
+    """
+    results = []
+    buffer = bytearray(1 << 16)
+    with socket.create_connection(address) as conn:
+        for _ in range(rounds):
+            # older proxies needed some time to notice the end of the last chunk
+            time.sleep(pause)
+            start = time.perf_counter()
+            conn.sendall(REQUEST)
+            left = size
+            while left:
+                received = conn.recv_into(buffer, min(left, len(buffer)))
+                if not received:
+                    raise ConnectionError('connection closed after %d bytes' % (size - left))
+                left -= received
+            results.append(size / (time.perf_counter() - start))
+    return results
+
+
+def measure_exchanges(address, count):
+    """
+    send count short requests to address one after another, return the seconds per exchange
+    """
+    with socket.create_connection(address) as conn:
+        start = time.perf_counter()
+        for _ in range(count):
+            conn.sendall(EXCHANGE)
+            left = EXCHANGE_ANSWER_SIZE
+            while left:
+                received = len(conn.recv(left))
+                if not received:
+                    raise ConnectionError('connection closed')
+                left -= received
+        return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]",
+                          description="Measure the throughput of the TCP proxy of samsungScannerServer.")
+    parser.add_option("--megabytes", type="int", dest="megabytes", default=64,
+                      help="Scan data per round in MiB [default: %default]")
+    parser.add_option("--rounds", type="int", dest="rounds", default=3,
+                      help="Number of rounds [default: %default]")
+    parser.add_option("--pause", type="float", dest="pause", default=0.0,
+                      help="Seconds to wait between rounds [default: %default]")
+    parser.add_option("--exchanges", type="int", dest="exchanges", default=20,
+                      help="Number of short request/answer exchanges to time [default: %default]")
+    parser.add_option("--set", action="append", dest="settings", default=[], metavar="SETTING=VALUE",
+                      help="Configuration line to use for the daemon, e.g. --set PROXY_DEBUGLEVEL=3 (repeatable)")
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.error("incorrect number of arguments")
+
+    size = options.megabytes << 20
+    # log records the proxy emits at PROXY_DEBUGLEVEL are formatted and written like in the daemon
+    logging.basicConfig(filename=os.devnull, level=logging.INFO)
+    scanner = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    scanner.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    scanner.bind((SCANNER_IP, 9400))
+    scanner.listen(5)
+    threading.Thread(target=serve_scan_data, args=(scanner, size), daemon=True).start()
+    fake = FakeScanner(SCANNER_IP).start()
+    work_dir = tempfile.mkdtemp(prefix='samsungScannerServer-benchmark-')
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            server = import_server(work_dir, fake, options.settings)
+        control, proxy_control = server.ProxyControl.pair()
+        proxy = server.TCProxy(SCANNER_IP, PROXY_IP, proxy_control)
+        proxy.start()
+        try:
+            direct = measure((SCANNER_IP, 9400), size, options.rounds, options.pause)
+            proxied = measure((PROXY_IP, 9400), size, options.rounds, options.pause)
+            direct_exchange = measure_exchanges((SCANNER_IP, 9400), options.exchanges)
+            proxied_exchange = measure_exchanges((PROXY_IP, 9400), options.exchanges)
+        finally:
+            proxy.join()
+    finally:
+        scanner.close()
+        fake.stop()
+        shutil.rmtree(work_dir)
+
+    print('%d round(s) of %d MiB, PROXY_DEBUGLEVEL %d' % (options.rounds, options.megabytes, server.PROXY_DEBUGLEVEL))
+    for name, results, exchange in (('direct', direct, direct_exchange), ('proxy', proxied, proxied_exchange)):
+        print('%-7s %8.1f MiB/s (min %.1f, max %.1f), %.2f ms per exchange' % (
+            name + ':', sum(results) / len(results) / (1 << 20), min(results) / (1 << 20),
+            max(results) / (1 << 20), exchange * 1000))
+
+
+if __name__ == '__main__':
+    main()